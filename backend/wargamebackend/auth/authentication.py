@@ -2,9 +2,14 @@
 # That specifies how the user who sent an HTTP request is identified.
 # It can determine whether a user isn't logged in
 # or has expired or invalid authentication credentials.
+# The user an access token belongs to is cached (see user_cache.py),
+# so most requests are authenticated without querying the database.
 
+from channels.db import database_sync_to_async
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import ExpiredTokenError, InvalidToken, AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from auth.user_cache import get_cached_user, get_cached_user_nowait, cache_user
 
 
 class CookieJWTAuthentication(JWTAuthentication):
@@ -26,4 +31,39 @@ class CookieJWTAuthentication(JWTAuthentication):
             raise AuthenticationFailed(detail="expired_token")
 
         except InvalidToken:
-            raise AuthenticationFailed(detail="invalid_token")
\ No newline at end of file
+            raise AuthenticationFailed(detail="invalid_token")
+
+    def get_user(self, validated_token):
+        """
+        The user the token belongs to, from the cache if they're in it.
+        Tokens that are revoked when the user's password changes need the password hash to be checked,
+        which isn't cached, so with CHECK_REVOKE_TOKEN the user is always loaded from the database.
+        """
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+
+        if user_id is None or api_settings.CHECK_REVOKE_TOKEN:
+            return super().get_user(validated_token)
+
+        user = get_cached_user(user_id)
+
+        if user is None:
+            # Inactive and missing users raise AuthenticationFailed here, so they're never cached.
+            user = super().get_user(validated_token)
+            cache_user(user)
+
+        return user
+
+    async def aget_user(self, validated_token):
+        """
+        get_user for the event loop (see middleware.py). Users cached in this process's memory are returned
+        straight away, and only the others are loaded in a thread, from Redis or the database.
+        """
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+
+        if user_id is not None and not api_settings.CHECK_REVOKE_TOKEN:
+            user = get_cached_user_nowait(user_id)
+
+            if user is not None:
+                return user
+
+        return await database_sync_to_async(self.get_user)(validated_token)
@@ -8,11 +8,10 @@ from django.shortcuts import get_object_or_404
 from rest_framework import status
 from rest_framework.response import Response
 from functools import wraps
+from operator import attrgetter
 import inspect
 from datetime import datetime
-from wargamelogic.models import (
-    RoleInstance
-)
+from auth.role_cache import get_role_memberships
 
 
 # ------------------------ #
@@ -105,15 +104,6 @@ def _extract_request(args, kwargs, view_func):
 
     return None, None
 
-def get_nested_attr(obj, attr, default=None):
-    try:
-        for part in attr.split('.'):
-            obj = getattr(obj, part)
-        return obj
-
-    except AttributeError:
-        return default
-
 def _json_safe(value):
     if value is None or isinstance(value, (bool, int, float, str)):
         return value
@@ -138,89 +128,168 @@ def _json_safe_dict(d):
 # ------------------------ #
 # Core role checking       #
 # ------------------------ #
-def get_user_role_instances(request):
+# Criteria fields that pin down which game the RoleInstance has to be in, mapped to
+# the filter that finds the user's RoleInstances in that game from the field's expected value.
+# Criteria with one of these fields only load the user's RoleInstances in that game,
+# rather than every one they've had in every game they've played.
+GAME_SCOPES = {
+    "team_instance.game_instance.join_code": lambda join_code: {"team_instance__game_instance__join_code": join_code},
+    "team_instance.game_instance": lambda game_instance: {"team_instance__game_instance_id": game_instance.pk},
+    "team_instance": lambda team_instance: {"team_instance__game_instance_id": team_instance.game_instance_id},
+}
+
+def get_user_role_instances(request, **filters):
     """
-    Fetch and cache the requesting user's RoleInstances for this request.
+    Fetch and cache the requesting user's RoleInstances for this request,
+    optionally only those matching filters, e.g. team_instance__game_instance_id=1.
+    They're shared with other requests (see role_cache.py), so they must not be modified.
     """
     cache = _get_request_cache(request)
+    key = ("role_instances", frozenset(filters.items()))
 
-    if "role_instances" not in cache:
-        cache["role_instances"] = list(
-            RoleInstance.objects.filter(user=request.user).select_related(
-                "role", "team_instance__team", "team_instance__game_instance"
-            )
-        )
+    if key not in cache:
+        cache[key] = get_role_memberships(request.user, **filters)
 
-    return cache["role_instances"]
+    return cache[key]
 
-def role_instance_matches(request, kwargs, criteria):
-    if request.user.is_staff or request.user.is_superuser:
-        return True, {}
+class CompiledCriteria:
+    """
+    Criteria compiled when a view is decorated, so checking them does as little work as possible:
+    - Fields are read with getters built once, rather than by splitting their names on every check.
+    - Fixed expected values are checked before callable ones, so e.g. a role that isn't "Gamemaster"
+      fails without the callable's database lookup being made. The exception is the callable for
+      a field in GAME_SCOPES, which always runs first, since its result picks which RoleInstances are loaded.
+    - Each callable is called at most once per request, however many RoleInstances the user has,
+      and its result (or error) is reused for the 403 response if none of them match.
+    - A RoleInstance stops being checked at its first field that doesn't match.
+    - If a field is in GAME_SCOPES, only the user's RoleInstances in that game are loaded.
+    """
+    def __init__(self, criteria):
+        self.criteria = criteria
+        checks = [(field, attrgetter(field), expected, callable(expected)) for field, expected in criteria.items()]
+        self.checks = sorted(checks, key=lambda check: check[3])
+        self.scope_field = next((field for field in criteria if field in GAME_SCOPES), None)
+
+    def expected_value(self, request, kwargs, field, expected, is_callable, expected_values):
+        """Returns (expected value, error), calling the expected value if it's callable and hasn't been already."""
+        if not is_callable:
+            return expected, None
+
+        if field not in expected_values:
+            try:
+                expected_values[field] = (expected(request, kwargs), None)
+
+            except Exception as e:
+                expected_values[field] = (None, e)
 
-    role_instances = get_user_role_instances(request)
+        return expected_values[field]
 
-    failed_fields = {}
+    def role_instances(self, request, kwargs, expected_values):
+        """
+        Returns (the user's RoleInstances that could match the criteria, failed fields),
+        where failed fields is the scoping field if its expected value couldn't be found, or else None.
+        """
+        if self.scope_field is None:
+            return get_user_role_instances(request), None
 
-    for role_instance in role_instances:
-        match = True
-        for field, expected in criteria.items():
-            actual_value = get_nested_attr(role_instance, field, None)
+        expected = self.criteria[self.scope_field]
+        expected, error = self.expected_value(request, kwargs, self.scope_field, expected, callable(expected), expected_values)
 
-            if callable(expected):
+        if error is not None:
+            return [], {self.scope_field: f"<error: {error}>"}
+
+        if expected is None:
+            return [], None
+
+        if isinstance(expected, (QuerySet, list, set, tuple)):
+            return get_user_role_instances(request), None
+
+        return get_user_role_instances(request, **GAME_SCOPES[self.scope_field](expected)), None
+
+    def matches(self, request, kwargs, role_instances, expected_values):
+        """
+        Returns (True, {}) if any of the role instances matches the criteria,
+        otherwise (False, the fields that didn't match and their actual values).
+        expected_values is where the callables' results are kept for this request.
+        """
+        failed_fields = {}
+
+        for role_instance in role_instances:
+            for field, getter, expected, is_callable in self.checks:
+                expected, error = self.expected_value(request, kwargs, field, expected, is_callable, expected_values)
+
+                if error is not None:
+                    failed_fields[field] = f"<error: {error}>"
+                    break
 
                 try:
-                    expected = expected(request, kwargs)
+                    actual_value = getter(role_instance)
+
+                except AttributeError:
+                    actual_value = None
 
-                except Exception as e:
-                    failed_fields[field] = f"<error: {e}>"
-                    match = False
-                    continue
+                if isinstance(expected, (QuerySet, list, set, tuple)):
+                    matched = actual_value in expected
+                else:
+                    matched = actual_value == expected
 
-            if isinstance(expected, (QuerySet, list, set, tuple)):
-                if actual_value not in expected:
+                if not matched:
                     failed_fields[field] = actual_value
-                    match = False
+                    break
+
             else:
-                if actual_value != expected:
-                    failed_fields[field] = actual_value
-                    match = False
-        if match:
-            return True, {}
+                return True, {}
+
+        return False, failed_fields
 
-    return False, failed_fields
+    def describe(self, request, kwargs, expected_values):
+        """The criteria with their callables' results, for the 403 response."""
+        computed_criteria = {}
+
+        for field, expected in self.criteria.items():
+            expected, error = self.expected_value(request, kwargs, field, expected, callable(expected), expected_values)
+            computed_criteria[field] = f"<error: {error}>" if error is not None else expected
+
+        return computed_criteria
+
+def role_instance_matches(request, kwargs, criteria, expected_values=None):
+    if request.user.is_staff or request.user.is_superuser:
+        return True, {}
+
+    if not isinstance(criteria, CompiledCriteria):
+        criteria = CompiledCriteria(criteria)
+
+    if expected_values is None:
+        expected_values = {}
+
+    role_instances, failed_fields = criteria.role_instances(request, kwargs, expected_values)
+
+    if failed_fields:
+        return False, failed_fields
+
+    return criteria.matches(request, kwargs, role_instances, expected_values)
 
 # ------------------------ #
 # Decorators               #
 # ------------------------ #
 
 def require_role_instance(criteria):
+    compiled_criteria = CompiledCriteria(criteria)
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view(*args, **kwargs):
             self, request = _extract_request(args, kwargs, view_func)
             try:
-                matches, failed_fields = role_instance_matches(request, kwargs, criteria)
+                expected_values = {}
+                matches, failed_fields = role_instance_matches(request, kwargs, compiled_criteria, expected_values)
 
                 if matches:
                     return view_func(*args, **kwargs)
 
-                computed_criteria = {}
-                for k, v in criteria.items():
-                    if callable(v):
-
-                        try:
-                            result = v(request, kwargs)
-                            computed_criteria[k] = result
-
-                        except Exception as e:
-                            computed_criteria[k] = f"<error: {e}>"
-
-                    else:
-                        computed_criteria[k] = v
-
                 return Response({
                     "detail": "You do not have the required role",
-                    "allowed_role": _json_safe_dict(computed_criteria),
+                    "allowed_role": _json_safe_dict(compiled_criteria.describe(request, kwargs, expected_values)),
                     "failed_fields": _json_safe_dict(failed_fields)
                 }, status=status.HTTP_403_FORBIDDEN)
 
@@ -232,35 +301,28 @@ def require_role_instance(criteria):
     return decorator
 
 def require_any_role_instance(criteria_list):
+    compiled_criteria_list = [CompiledCriteria(criteria) for criteria in criteria_list]
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view(*args, **kwargs):
             self, request = _extract_request(args, kwargs, view_func)
             try:
+                all_expected_values = []
                 all_failed_fields = []
-                for criteria in criteria_list:
-                    matches, failed_fields = role_instance_matches(request, kwargs, criteria)
+                for compiled_criteria in compiled_criteria_list:
+                    expected_values = {}
+                    matches, failed_fields = role_instance_matches(request, kwargs, compiled_criteria, expected_values)
 
                     if matches:
                         return view_func(*args, **kwargs)
+                    all_expected_values.append(expected_values)
                     all_failed_fields.append(_json_safe_dict(failed_fields))
 
-                serialized_criteria_list = []
-                for criteria in criteria_list:
-                    computed_criteria = {}
-                    for k, v in criteria.items():
-                        if callable(v):
-
-                            try:
-                                result = v(request, kwargs)
-                                computed_criteria[k] = result
-
-                            except Exception as e:
-                                computed_criteria[k] = f"<error: {e}>"
-
-                        else:
-                            computed_criteria[k] = v
-                    serialized_criteria_list.append(_json_safe_dict(computed_criteria))
+                serialized_criteria_list = [
+                    _json_safe_dict(compiled_criteria.describe(request, kwargs, expected_values))
+                    for compiled_criteria, expected_values in zip(compiled_criteria_list, all_expected_values)
+                ]
 
                 return Response({
                     "detail": "You do not have a required role",
@@ -1,15 +1,27 @@
 # The purpose of this file is similar to that of authentication.py,
 # but this one is specifically for authenticating WebSocket connections.
 # It is used in asgi.py.
+# It shares one CookieJWTAuthentication, and so the same cache of users, with the REST API,
+# so when everyone reconnects at once (e.g. after a deploy), the users who were recently
+# authenticated by this process don't each need a thread to query the database.
 
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import UntypedToken
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from channels.db import database_sync_to_async
-from http.cookies import SimpleCookie
+from django.http.cookie import parse_cookie
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from auth.authentication import CookieJWTAuthentication
 
 
+authenticator = CookieJWTAuthentication()
+
+def get_access_token(scope):
+    """The access token from the connection's cookies, or None if there isn't one."""
+    for name, value in scope["headers"]:
+        # ASGI servers give header names in lowercase.
+        if name == b"cookie":
+            return parse_cookie(value.decode("latin-1")).get("access_token")
+
+    return None
+
 class CookieJWTAuthenticationWebSocketMiddleware:
     """
     Authentication class for WebSockets that reads the JWT access token from a cookie.
@@ -18,25 +30,16 @@ class CookieJWTAuthenticationWebSocketMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
-        headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
-        cookie_header = headers.get("cookie", "")
-        cookies = SimpleCookie()
-        cookies.load(cookie_header)
-        token = cookies.get("access_token").value if "access_token" in cookies else None
+        token = get_access_token(scope)
+        scope["user"] = AnonymousUser()
 
         if token:
             try:
-                UntypedToken(token)  # Raises InvalidToken if invalid or expired
-                jwt_auth = JWTAuthentication()
-                validated_token = jwt_auth.get_validated_token(token)
-
-                User = await database_sync_to_async(jwt_auth.get_user)(validated_token)
-                scope["user"] = User
-
-            except (InvalidToken, TokenError, Exception):
-                scope["user"] = AnonymousUser()
+                # Raises InvalidToken if the token is invalid or expired.
+                validated_token = authenticator.get_validated_token(token)
+                scope["user"] = await authenticator.aget_user(validated_token)
 
-        else:
-            scope["user"] = AnonymousUser()
+            except (AuthenticationFailed, TokenError):
+                pass
 
-        return await self.app(scope, receive, send)
\ No newline at end of file
+        return await self.app(scope, receive, send)
@@ -0,0 +1,97 @@
+# This file caches users' RoleInstances, which authorization.py checks on every authorized request,
+# so that checking them doesn't query the database. Roles are rarely reassigned during a game.
+#
+# Each user's RoleInstances are cached per game (or for all games, for criteria that aren't about one)
+# in Redis, and in front of that, in each process's memory, for settings.ROLE_MEMBERSHIP_CACHE_TTL seconds.
+# Like the StaticCatalog (see wargamelogic/static_cache.py), entries are tagged with version numbers
+# stored in Redis: one for each user, and one for everyone's.
+# Saving or deleting one of the user's RoleInstances, or the user themselves, bumps the user's
+# (see wargamelogic/signals.py), as does RoleInstanceViewSet moving a RoleInstance to another user.
+# Since the RoleInstances are cached with their roles, branches, teams and games, saving or deleting any of those
+# (or a TeamInstance) bumps everyone's. Either way, every process loads the RoleInstances again the next time it notices.
+# The cached RoleInstances are shared by every request on the process, so they must not be modified.
+# Their ready flags may be out of date, since set_turn clears them with an update, which sends no signals.
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from auth.user_cache import LocalCache
+from wargamelogic.models import (
+    RoleInstance
+)
+from wargamelogic.redis_clients import get_redis_client
+
+
+ALL_ROLE_MEMBERSHIPS_VERSION_KEY = "role_memberships_version"
+
+def _version_key(user_id):
+    return f"role_memberships_version_{user_id}"
+
+def _decode_version(version):
+    return int(version) if version is not None else 0
+
+def _get_version(user_id):
+    """The version of the user's cached RoleInstances, which changes when either of its numbers is bumped."""
+    versions = get_redis_client().mget(ALL_ROLE_MEMBERSHIPS_VERSION_KEY, _version_key(user_id))
+    return "_".join(str(_decode_version(version)) for version in versions)
+
+def _scope(filters):
+    return "&".join(f"{lookup}={value}" for lookup, value in sorted(filters.items()))
+
+_local_role_memberships = None
+
+def _get_local_role_memberships():
+    global _local_role_memberships
+
+    if _local_role_memberships is None:
+        _local_role_memberships = LocalCache(settings.ROLE_MEMBERSHIP_CACHE_MAXSIZE, settings.ROLE_MEMBERSHIP_CACHE_TTL)
+
+    return _local_role_memberships
+
+def get_role_memberships(user, **filters):
+    """
+    The user's RoleInstances matching filters (e.g. team_instance__game_instance_id=1),
+    with their roles, teams and games, from this process's memory, Redis or the database, in that order.
+    """
+    version = _get_version(user.id)
+    scope = _scope(filters)
+    local_role_memberships = _get_local_role_memberships()
+
+    entry = local_role_memberships.get((user.id, scope))
+
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    key = f"role_memberships_{user.id}_{version}_{scope}"
+    role_instances = cache.get(key)
+
+    if role_instances is None:
+        role_instances = list(
+            RoleInstance.objects.filter(user=user, **filters).select_related(
+                "role__branch", "team_instance__team", "team_instance__game_instance"
+            )
+        )
+        cache.set(key, role_instances, settings.ROLE_MEMBERSHIP_CACHE_TTL)
+
+    local_role_memberships.set((user.id, scope), (version, role_instances))
+    return role_instances
+
+def invalidate_role_memberships(user_id):
+    """
+    Makes every process load the user's RoleInstances again.
+    The version is bumped right away, and again once the current transaction commits,
+    so that a process that loaded them before the commit doesn't keep the old rows.
+    """
+    def bump():
+        get_redis_client().incr(_version_key(user_id))
+
+    bump()
+    transaction.on_commit(bump)
+
+def invalidate_all_role_memberships():
+    """Makes every process load every user's RoleInstances again, like invalidate_role_memberships."""
+    def bump():
+        get_redis_client().incr(ALL_ROLE_MEMBERSHIPS_VERSION_KEY)
+
+    bump()
+    transaction.on_commit(bump)
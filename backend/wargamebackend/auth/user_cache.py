@@ -0,0 +1,129 @@
+# This file caches the users that access tokens belong to, so that authenticating a request
+# (see authentication.py) or a WebSocket connection (see middleware.py) doesn't need to query
+# the auth_user table every time. Game clients make a lot of requests, and the user rarely changes.
+#
+# Users are cached by id (as a string, which is how tokens hold it) for settings.AUTH_USER_CACHE_TTL seconds, either
+#   - in each process's memory, holding up to settings.AUTH_USER_CACHE_MAXSIZE users, or
+#   - in Redis, if settings.AUTH_USER_CACHE_REDIS is True, so every process shares them.
+# A user's entry is deleted when they're saved or deleted (see wargamelogic/signals.py).
+# In memory, that only reaches the process the change was made in,
+# so other processes can keep using their copy until it expires: settings.AUTH_USER_CACHE_TTL is how long
+# e.g. a deactivated user can still be authenticated. Logging out doesn't revoke the access token,
+# so it doesn't touch the cache either; the token stays valid until it expires, cached or not.
+# Only the fields in CACHED_USER_FIELDS are cached (never the password hash).
+# Any other field is loaded from the database if it's used.
+
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+
+# In the order they're defined on User, which is the order User.from_db expects them in.
+CACHED_USER_FIELDS = ("id", "is_superuser", "username", "is_staff", "is_active")
+
+def _cache_key(user_id):
+    return f"auth_user_{user_id}"
+
+class LocalCache:
+    """A bounded, least recently used cache in this process's memory, whose entries expire after ttl seconds."""
+    # Whether looking a user up waits on the network.
+    blocking = False
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class RedisUserCache:
+    """Users' fields, cached in Redis through Django's cache."""
+    blocking = True
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def get(self, user_id):
+        return cache.get(_cache_key(user_id))
+
+    def set(self, user_id, values):
+        cache.set(_cache_key(user_id), values, self.ttl)
+
+    def delete(self, user_id):
+        cache.delete(_cache_key(user_id))
+
+_local_user_cache = None
+
+def get_user_cache():
+    global _local_user_cache
+
+    if settings.AUTH_USER_CACHE_REDIS:
+        return RedisUserCache(settings.AUTH_USER_CACHE_TTL)
+
+    if _local_user_cache is None:
+        _local_user_cache = LocalCache(settings.AUTH_USER_CACHE_MAXSIZE, settings.AUTH_USER_CACHE_TTL)
+
+    return _local_user_cache
+
+def get_cached_user(user_id):
+    """
+    The cached user with the given id, or None if they aren't cached.
+    Each call returns a new User instance, so changing one doesn't change the cache.
+    """
+    values = get_user_cache().get(str(user_id))
+
+    if values is None:
+        return None
+
+    return User.from_db(DEFAULT_DB_ALIAS, CACHED_USER_FIELDS, values)
+
+def get_cached_user_nowait(user_id):
+    """
+    Like get_cached_user, but returns None rather than wait on Redis if the users are cached there,
+    so it can be called from the event loop.
+    """
+    if get_user_cache().blocking:
+        return None
+
+    return get_cached_user(user_id)
+
+def cache_user(user):
+    get_user_cache().set(str(user.id), tuple(getattr(user, field) for field in CACHED_USER_FIELDS))
+
+def invalidate_cached_user(user_id):
+    get_user_cache().delete(str(user_id))
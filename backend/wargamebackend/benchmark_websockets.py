@@ -0,0 +1,359 @@
+# Measures how quickly the GameConsumer delivers messages under load,
+# to help decide how many workers to run before a tournament.
+# It drives the ASGI application from wargamebackend/asgi.py in this process with
+# --clients simulated WebSocket clients spread over --games games. Each one logs in with
+# a real access token cookie, joins the game as a team and role, then sends a mix of
+# broadcast, communications.send and points.send messages.
+# Every message carries the time it was sent, so each delivery's latency can be measured,
+# and the p50/p95/p99 latencies and messages per second are printed at the end.
+#
+# The teams, roles, users and RoleInstances it needs are created in a throwaway test database,
+# the same way `python manage.py test` does, so nothing is written to the real one.
+# Redis must be running, since presence and the event log are always stored there.
+#
+# usage: python benchmark_websockets.py --clients 200 --games 10 --messages 50 [--layer memory]
+
+import os
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import django
+
+
+# Set up Django environment
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wargamebackend.settings")
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+from wargamelogic.models.static import Team, Branch, Role
+from wargamelogic.models.dynamic import GameInstance, TeamInstance, RoleInstance
+from wargamelogic.layers import delivery_counters
+from wargamelogic.redis_clients import get_game_redis_clients
+from wargamelogic.topology import (
+    GAMEMASTER_TEAM_NAME, GAMEMASTER_ROLE_NAME, get_channel_partners, get_transfer_partners
+)
+
+
+JOIN_CODE_PREFIX = "BENCH"
+
+# How often each kind of message is sent, relative to the others.
+MESSAGE_MIX = {
+    "broadcast": 6,
+    "communications": 3,
+    "points": 1,
+}
+
+# ------------------------ #
+# Fixtures                 #
+# ------------------------ #
+def create_benchmark_fixtures(teams, clients):
+    """
+    Creates the Gamemasters team and the given number of other teams,
+    a set of roles covering every kind of channel and transfer partner,
+    and a user for each client.
+    Returns the teams, the roles and the users.
+    """
+    team_objects = [Team.objects.get_or_create(name=GAMEMASTER_TEAM_NAME)[0]] + [
+        Team.objects.get_or_create(name=f"Team {i + 1}")[0]
+        for i in range(teams)
+    ]
+
+    army = Branch.objects.get_or_create(name="Army")[0]
+    role_objects = [
+        Role.objects.get_or_create(name=GAMEMASTER_ROLE_NAME)[0],
+        Role.objects.get_or_create(name="Combatant Commander")[0],
+        Role.objects.get_or_create(name="Ambassador")[0],
+        Role.objects.get_or_create(name="Army Chief of Staff", defaults={
+            "branch": army, "is_chief_of_staff": True, "is_logistics": True
+        })[0],
+        Role.objects.get_or_create(name="Army Commander", defaults={
+            "branch": army, "is_commander": True, "is_logistics": True
+        })[0],
+        Role.objects.get_or_create(name="Army Vice Commander", defaults={
+            "branch": army, "is_vice_commander": True, "is_logistics": True
+        })[0],
+    ]
+
+    users = [
+        User.objects.get_or_create(username=f"bench_user_{i}")[0]
+        for i in range(clients)
+    ]
+
+    return team_objects, role_objects, users
+
+def get_role_slots(teams, roles):
+    """
+    The (team, role) pairs that the clients in a game join as, in order:
+    the Gamemaster first, then every other role on every other team.
+    """
+    gamemaster_team = next(team for team in teams if team.name == GAMEMASTER_TEAM_NAME)
+    gamemaster_role = next(role for role in roles if role.name == GAMEMASTER_ROLE_NAME)
+
+    return [(gamemaster_team, gamemaster_role)] + [
+        (team, role)
+        for team in teams if team.name != GAMEMASTER_TEAM_NAME
+        for role in roles if role.name != GAMEMASTER_ROLE_NAME
+    ]
+
+def create_benchmark_role_instances(teams, roles, users, games):
+    """
+    Spreads the users evenly over the games, giving each of them a RoleInstance in theirs.
+    Returns (user, join code, team, role) for each user.
+    """
+    slots = get_role_slots(teams, roles)
+    clients_per_game = -(-len(users) // games)
+
+    if clients_per_game > len(slots):
+        raise Exception(f"Only {len(slots)} clients can join each game, but {clients_per_game} were asked for. Add more games or teams.")
+
+    assignments = []
+    team_instances = {}
+
+    for i, user in enumerate(users):
+        team, role = slots[i // games]
+        join_code = f"{JOIN_CODE_PREFIX}{i % games}"
+
+        if (join_code, team.id) not in team_instances:
+            game_instance = GameInstance.objects.get_or_create(join_code=join_code)[0]
+            team_instances[(join_code, team.id)] = TeamInstance.objects.get_or_create(game_instance=game_instance, team=team)[0]
+
+        RoleInstance.objects.create(user=user, team_instance=team_instances[(join_code, team.id)], role=role)
+        assignments.append((user, join_code, team, role))
+
+    return assignments
+
+# ------------------------ #
+# Clients                  #
+# ------------------------ #
+class BenchmarkClient:
+    def __init__(self, application, user, join_code, team, role, teams, roles):
+        self.user = user
+        self.join_code = join_code
+        self.channel_partners = get_channel_partners(team.name, role, teams, roles)
+        self.transfer_recipients, _ = get_transfer_partners(team.name, role, teams, roles)
+
+        token = AccessToken.for_user(user)
+        self.communicator = WebsocketCommunicator(
+            application,
+            f"/ws/game-instances/{join_code}/",
+            headers=[(b"cookie", f"access_token={token}".encode())]
+        )
+        self.joined = asyncio.Event()
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+
+        if not connected:
+            raise Exception(f"{self.user.username} could not connect to game '{self.join_code}'.")
+
+    async def join(self):
+        await self.communicator.send_json_to({
+            "channel": "users",
+            "action": "join",
+            "data": {},
+        })
+
+    def next_message(self, rng, message_id):
+        """Picks the next message to send, falling back to a broadcast if there's nobody to send it to."""
+        kind = rng.choices(list(MESSAGE_MIX), weights=list(MESSAGE_MIX.values()))[0]
+        partners = {
+            "communications": self.channel_partners,
+            "points": self.transfer_recipients,
+        }.get(kind)
+
+        if not partners:
+            return {
+                "channel": "units",
+                "action": "move",
+                "data": {"id": message_id, "sent_at": time.perf_counter()},
+            }
+
+        recipient_team_name, recipient_role_name = rng.choice(partners)
+
+        return {
+            "channel": kind,
+            "action": "send",
+            "data": {
+                "recipient_team_name": recipient_team_name,
+                "recipient_role_name": recipient_role_name,
+                "sent_at": time.perf_counter(),
+            },
+        }
+
+    async def send_messages(self, count, interval, rng, stats):
+        for i in range(count):
+            await self.communicator.send_json_to(self.next_message(rng, f"{self.user.id}-{i}"))
+            stats["sent"] += 1
+            await asyncio.sleep(interval)
+
+    async def read(self, stats, idle_timeout):
+        """Records the latency of every message delivered to this client until it goes quiet."""
+        while True:
+            # Waiting with receive_json_from's timeout would cancel the consumer when it ran out,
+            # so this waits on the communicator's queue of frames instead.
+            try:
+                output = await asyncio.wait_for(self.communicator.output_queue.get(), idle_timeout)
+
+            except asyncio.TimeoutError:
+                return
+
+            if output["type"] != "websocket.send":
+                return
+
+            message = json.loads(output["text"])
+
+            received_at = time.perf_counter()
+
+            # Coalesced messages arrive as a batch of messages.
+            if message["channel"] == "batch":
+                messages = message["data"]
+            else:
+                messages = [message]
+
+            for delivered in messages:
+                data = delivered.get("data")
+                kind = f"{delivered['channel']}.{delivered['action']}"
+
+                if kind == "users.join" and data["user"]["id"] == self.user.id:
+                    self.joined.set()
+
+                if not isinstance(data, dict) or "sent_at" not in data:
+                    continue
+
+                stats["latencies"].setdefault(kind, []).append(received_at - data["sent_at"])
+                stats["delivered"] += 1
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+# ------------------------ #
+# Running                  #
+# ------------------------ #
+async def run_benchmark(application, teams, roles, assignments, messages, interval, idle_timeout=2.0, seed=0):
+    """
+    Connects a client for each (user, join code, team, role) in assignments, has them all join,
+    then has each of them send the given number of messages, one every interval seconds.
+    Returns the number of messages sent and delivered, how long sending and delivering took,
+    and the delivery latencies in seconds for each kind of message.
+    """
+    clients = [
+        BenchmarkClient(application, user, join_code, team, role, teams, roles)
+        for user, join_code, team, role in assignments
+    ]
+
+    stats = {"sent": 0, "delivered": 0, "latencies": {}}
+
+    try:
+        await asyncio.gather(*(client.connect() for client in clients))
+        readers = [asyncio.create_task(client.read(stats, idle_timeout)) for client in clients]
+
+        await asyncio.gather(*(client.join() for client in clients))
+        await asyncio.wait_for(asyncio.gather(*(client.joined.wait() for client in clients)), timeout=30)
+
+        rng = random.Random(seed)
+        started_at = time.perf_counter()
+        delivered_before = stats["delivered"]
+
+        await asyncio.gather(*(
+            client.send_messages(messages, interval, random.Random(rng.random()), stats)
+            for client in clients
+        ))
+        await asyncio.gather(*readers)
+
+        # The readers only stop after going quiet for idle_timeout seconds.
+        elapsed = max(time.perf_counter() - started_at - idle_timeout, 1e-9)
+
+    finally:
+        await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+    return {
+        "sent": stats["sent"],
+        "delivered": stats["delivered"] - delivered_before,
+        "elapsed": elapsed,
+        "latencies": stats["latencies"],
+    }
+
+def percentiles(latencies):
+    """p50, p95 and p99 of the latencies, in milliseconds."""
+    if len(latencies) == 1:
+        return (latencies[0] * 1000,) * 3
+
+    cut_points = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cut_points[49] * 1000, cut_points[94] * 1000, cut_points[98] * 1000
+
+def print_report(results, clients, games):
+    print(f"{clients} clients in {games} games")
+    print(f"sent {results['sent']} messages and delivered {results['delivered']} in {results['elapsed']:.2f}s")
+    print(f"{results['sent'] / results['elapsed']:.0f} messages/sec sent, {results['delivered'] / results['elapsed']:.0f} messages/sec delivered")
+    print()
+    print(f"{'message':<24}{'deliveries':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+
+    all_latencies = []
+
+    for kind, latencies in sorted(results["latencies"].items()):
+        all_latencies += latencies
+        print(f"{kind:<24}{len(latencies):>12}" + "".join(f"{p:>10.2f}" for p in percentiles(latencies)))
+
+    if all_latencies:
+        print(f"{'all':<24}{len(all_latencies):>12}" + "".join(f"{p:>10.2f}" for p in percentiles(all_latencies)))
+
+    # Only counted by the Redis channel layer with local_delivery on (see wargamelogic/layers.py).
+    if delivery_counters:
+        print()
+        print(f"{delivery_counters['local']} group messages delivered in-process, {delivery_counters['redis']} through Redis")
+
+def clear_benchmark_keys():
+    """
+    Deletes the benchmark games' keys, including their channel layer groups,
+    which would otherwise still list the clients of earlier runs.
+    """
+    group_prefix = settings.CHANNEL_LAYERS["default"].get("CONFIG", {}).get("prefix", "asgi")
+
+    for redis_client in get_game_redis_clients():
+        keys = redis_client.keys(f"game_{JOIN_CODE_PREFIX}*") + redis_client.keys(f"{group_prefix}:group:game_{JOIN_CODE_PREFIX}*")
+
+        if keys:
+            redis_client.delete(*keys)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure GameConsumer message delivery under load.")
+    parser.add_argument("--clients", type=int, default=100, help="number of WebSocket clients")
+    parser.add_argument("--games", type=int, default=5, help="number of games the clients are spread over")
+    parser.add_argument("--teams", type=int, default=2, help="number of teams in each game, besides the Gamemasters")
+    parser.add_argument("--messages", type=int, default=20, help="number of messages each client sends")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds each client waits between messages")
+    parser.add_argument("--layer", choices=["redis", "memory"], default="redis", help="channel layer to use")
+    parser.add_argument("--seed", type=int, default=0, help="seed for choosing messages")
+    args = parser.parse_args()
+
+    if args.layer == "memory":
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+    # The clients send as fast as they're told to, so they aren't rate limited (see wargamelogic/rate_limit.py).
+    settings.WEBSOCKET_RATE_LIMIT = None
+    settings.WEBSOCKET_ACTION_RATE_LIMIT = None
+    settings.WEBSOCKET_ACTION_RATE_LIMITS = {}
+
+    from wargamebackend.asgi import application
+
+    clear_benchmark_keys()
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    try:
+        teams, roles, users = create_benchmark_fixtures(args.teams, args.clients)
+        assignments = create_benchmark_role_instances(teams, roles, users, args.games)
+        results = asyncio.run(run_benchmark(
+            application, teams, roles, assignments, args.messages, args.interval, seed=args.seed
+        ))
+        print_report(results, args.clients, args.games)
+
+    finally:
+        clear_benchmark_keys()
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
@@ -0,0 +1,110 @@
+# Logging for the backend (see LOGGING in settings.py).
+# Records are put on a queue and written out by a background thread, so logging never makes
+# the event loop or a request's thread wait on the console or on the admins' mail being sent.
+# If the queue fills up, e.g. during a burst of errors, further records are dropped rather than waited on.
+#
+# Records are written as one JSON object per line, including whichever of STRUCTURED_FIELDS
+# were passed to the logger in extra, e.g.
+#
+#     logger.info("connected", extra={"join_code": join_code, "user_id": user.id})
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from django.conf import settings
+
+
+STRUCTURED_FIELDS = ("join_code", "user_id", "handler", "channel", "action", "status", "duration_ms")
+
+logger = logging.getLogger(__name__)
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Passes records on to handlers from a background thread.
+    In LOGGING, handlers is a list of references to other handlers, e.g. ["cfg://handlers.console"],
+    which must be configured before this one, so come before it alphabetically.
+    It must be built with "()" rather than "class", which Python 3.12 and later configure as a stdlib QueueHandler.
+    """
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+        # Items of lists in LOGGING are only resolved when they're indexed.
+        handlers = [handlers[i] for i in range(len(handlers))]
+
+        for handler in handlers:
+            if not isinstance(handler, logging.Handler):
+                raise ValueError(f"{handler!r} is not a handler")
+
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def prepare(self, record):
+        # The handlers run in this process, so the record is passed on as it is,
+        # keeping its traceback and request for mail_admins,
+        # but with its arguments merged into its message, in case they're changed afterwards.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+class RequestLogMiddleware:
+    """
+    Logs how long each request took, at DEBUG level, or WARNING if it took longer than
+    settings.SLOW_LOG_SECONDS, along with the view and the join code of the game it was for.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started_at = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - started_at
+
+        level = logging.WARNING if duration > settings.SLOW_LOG_SECONDS else logging.DEBUG
+
+        if logger.isEnabledFor(level):
+            match = request.resolver_match
+            user = getattr(request, "user", None)
+
+            logger.log(level, f"{request.method} {request.path} {response.status_code}", extra={
+                "handler": match.view_name if match else None,
+                "join_code": match.kwargs.get("join_code") if match else None,
+                "user_id": user.id if user and user.is_authenticated else None,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 3),
+            })
+
+        return response
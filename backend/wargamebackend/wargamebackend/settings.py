@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wargamebackend.log.RequestLogMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -150,15 +151,62 @@ USE_TZ = True
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
 
+# The Redis instances that games' WebSocket groups, presence and event logs are spread over by join code,
+# as a comma-separated list of URLs. Defaults to just REDIS_URL. See wargamelogic/sharding.py.
+GAME_REDIS_SHARDS = [url for url in os.getenv("GAME_REDIS_SHARDS", "").split(",") if url] or [REDIS_URL]
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "wargamelogic.layers.GameChannelLayer",
         "CONFIG": {
-            "hosts": [REDIS_URL],
+            # Like the cache's connection pool below, a busy worker needs more than redis-py's default of 100 connections.
+            "hosts": [{"address": url, "max_connections": 1000} for url in GAME_REDIS_SHARDS],
+            # Messages to consumers running in the same process skip Redis (see wargamelogic/layers.py).
+            "local_delivery": True,
         },
     },
 }
 
+# WebSocket channels whose messages are batched, mapped to how long (in seconds) to batch them for.
+# See wargamelogic/coalescing.py. For example: {"units": 0.05}
+WEBSOCKET_COALESCED_CHANNELS = {}
+
+# Roughly how many messages are kept in each game's WebSocket EventLog for replaying to reconnecting clients.
+# See wargamelogic/event_log.py.
+WEBSOCKET_EVENT_LOG_MAXLEN = 1000
+# How long, in seconds, a game's EventLog is kept after the last message was logged in it.
+WEBSOCKET_EVENT_LOG_TTL = 24 * 60 * 60
+
+# How many messages can be waiting to be sent to one WebSocket connection,
+# and what to do when that's exceeded ("drop_superseded" or "close"). See wargamelogic/outbound.py.
+WEBSOCKET_OUTBOUND_QUEUE_MAXLEN = 256
+WEBSOCKET_SLOW_CONSUMER_POLICY = "drop_superseded"
+
+# How often, in seconds, a joined WebSocket connection refreshes its presence entry,
+# and how long an entry lasts without being refreshed. See wargamelogic/presence.py.
+WEBSOCKET_PRESENCE_HEARTBEAT_INTERVAL = 15
+WEBSOCKET_PRESENCE_TTL = 45
+
+# How communications.send and points.send messages find their recipients. See wargamelogic/consumers.py.
+#   "topics": each user is only in their game's, team's and team and role's groups, and a message is sent
+#             to the sender's and recipient's team and role groups if the RoleTopology allows it.
+#   "pairs":  each user is also in a group for every pair of roles they can message or send supply points to,
+#             which for a Gamemaster is hundreds of groups.
+WEBSOCKET_ROUTING = "topics"
+
+# How fast one WebSocket connection can send messages, as (messages per second, burst), or None for no limit.
+# WEBSOCKET_RATE_LIMIT covers all of a connection's messages, and WEBSOCKET_ACTION_RATE_LIMIT each channel and action,
+# unless it's listed in WEBSOCKET_ACTION_RATE_LIMITS. See wargamelogic/rate_limit.py.
+WEBSOCKET_RATE_LIMIT = (30, 60)
+WEBSOCKET_ACTION_RATE_LIMIT = (15, 30)
+WEBSOCKET_ACTION_RATE_LIMITS = {
+    "actions.move": (5, 10),
+    "actions.attack": (2, 5),
+    "actions.transfer": (2, 5),
+    "users.list": (1, 5),
+    "events.replay": (1, 5),
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -174,6 +222,20 @@ CACHES = {
     }
 }
 
+# How long, in seconds, the users that access tokens belong to are cached for, so authenticating a request
+# doesn't query the database, and how many are cached in each process's memory.
+# If AUTH_USER_CACHE_REDIS is True, they're cached in Redis instead, and shared by every process. See auth/user_cache.py.
+# Changes to a user only clear the cache of the process they're made in, so other processes
+# can use the old user (e.g. one who was deactivated) for up to AUTH_USER_CACHE_TTL seconds.
+AUTH_USER_CACHE_TTL = 60
+AUTH_USER_CACHE_MAXSIZE = 10000
+AUTH_USER_CACHE_REDIS = False
+
+# How long, in seconds, users' RoleInstances are cached for, so checking their roles doesn't query the database,
+# and how many users' RoleInstances in a game are cached in each process's memory in front of Redis. See auth/role_cache.py.
+ROLE_MEMBERSHIP_CACHE_TTL = 300
+ROLE_MEMBERSHIP_CACHE_MAXSIZE = 10000
+
 raw_admins = os.getenv("ADMINS", "")
 ADMINS = [
     tuple(admin.split(":", 1))
@@ -182,6 +244,52 @@ ADMINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Logs are written by a background thread, so that writing them (or mailing them to the admins
+# in production) never holds up a request or the WebSocket's event loop. See wargamebackend/log.py.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# Requests and WebSocket messages taking longer than this many seconds are logged as warnings.
+SLOW_LOG_SECONDS = 1.0
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "structured": {
+            "()": "wargamebackend.log.StructuredFormatter",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "structured",
+        },
+        # Built with "()" rather than "class", since from Python 3.12 dictConfig configures QueueHandler
+        # classes itself, expecting handler names rather than cfg:// references in "handlers".
+        "queue": {
+            "()": "wargamebackend.log.BackgroundQueueHandler",
+            "handlers": ["cfg://handlers.console"],
+        },
+    },
+    "loggers": {
+        # Replaces Django's default handlers, whose mail_admins sends mail from the request's thread.
+        "django": {
+            "handlers": ["queue"],
+            "level": "INFO",
+        },
+        "wargamelogic": {
+            "handlers": ["queue"],
+            "level": LOG_LEVEL,
+            "propagate": False,
+        },
+        "wargamebackend": {
+            "handlers": ["queue"],
+            "level": LOG_LEVEL,
+            "propagate": False,
+        },
+    },
+}
+
 if DEBUG:
     ALLOWED_HOSTS = [
         "localhost",
@@ -234,24 +342,13 @@ else:
     EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
     EMAIL_USE_TLS = True
 
-    LOGGING = {
-        "version": 1,
-        "disable_existing_loggers": False,
-        "handlers": {
-            "mail_admins": {
-                "level": "ERROR",
-                "class": "django.utils.log.AdminEmailHandler",
-                "include_html": True,
-            },
-        },
-        "loggers": {
-            "django.request": {
-                "handlers": ["mail_admins"],
-                "level": "ERROR",
-                "propagate": True,
-            },
-        },
+    # Errors are mailed to the admins from the logging thread.
+    LOGGING["handlers"]["mail_admins"] = {
+        "level": "ERROR",
+        "class": "django.utils.log.AdminEmailHandler",
+        "include_html": True,
     }
+    LOGGING["handlers"]["queue"]["handlers"].append("cfg://handlers.mail_admins")
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
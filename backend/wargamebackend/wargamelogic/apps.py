@@ -1,17 +1,21 @@
+import logging
 from django.apps import AppConfig
 
 
+logger = logging.getLogger(__name__)
+
 class WargamelogicConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wargamelogic'
 
     def ready(self):
-        from wargamelogic.consumers import get_redis_client
+        import wargamelogic.signals
+        from wargamelogic.redis_clients import get_game_redis_clients
 
-        redis_client = get_redis_client()
-        keys = redis_client.keys("game_*")
+        for redis_client in get_game_redis_clients():
+            keys = redis_client.keys("game_*")
 
-        if keys:
-            redis_client.delete(*keys)
+            if keys:
+                redis_client.delete(*keys)
 
-        print("Redis game_ keys cleared on startup")
+        logger.info("Redis game_ keys cleared on startup")
@@ -0,0 +1,67 @@
+# This file lets messages on busy channels be batched instead of sent one at a time.
+# Channels listed in settings.WEBSOCKET_COALESCED_CHANNELS don't send each message straight away.
+# Instead, messages going to the same group are held for that channel's tick (in seconds),
+# and then sent together as a single message:
+# {
+#     "channel": "batch",
+#     "action": "tick",
+#     "data": [{"channel": ..., "action": ..., "data": ...}, ...]
+# }
+# If several messages in a tick have the same channel, action and data.id
+# (for example, a unit being dragged across the map), only the latest one is sent.
+# Batched messages can arrive after messages on other channels that were sent later.
+
+import asyncio
+import logging
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHANNEL = "batch"
+BATCH_ACTION = "tick"
+
+# Group name -> the messages waiting to be sent to it, for each running event loop.
+_pending_messages = weakref.WeakKeyDictionary()
+
+# The event loop only keeps weak references to tasks, so the flush tasks are kept here until they're done.
+_flush_tasks = set()
+
+def coalesce_message(send_to_group, group, channel, action, data, tick):
+    """
+    Queue a message to be sent to the group, along with every other message sent to it, after tick seconds.
+    send_to_group(group, channel, action, data) is awaited to send the batch.
+    """
+    loop = asyncio.get_running_loop()
+    pending_messages = _pending_messages.setdefault(loop, {})
+    messages = pending_messages.get(group)
+
+    if messages is None:
+        messages = pending_messages[group] = {}
+        task = loop.create_task(_flush_after(send_to_group, pending_messages, group, tick))
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+
+    entity_id = data.get("id") if isinstance(data, dict) else None
+    # Messages without an id never replace each other.
+    key = (channel, action, entity_id) if entity_id is not None else object()
+
+    # An update that replaces an older one moves to the end, since it was sent after the others.
+    messages.pop(key, None)
+    messages[key] = {
+        "channel": channel,
+        "action": action,
+        "data": data,
+    }
+
+async def _flush_after(send_to_group, pending_messages, group, tick):
+    try:
+        await asyncio.sleep(tick)
+    finally:
+        # Even if the task is cancelled, so that later messages to the group start a new batch.
+        messages = pending_messages.pop(group)
+
+    try:
+        await send_to_group(group, BATCH_CHANNEL, BATCH_ACTION, list(messages.values()))
+    except Exception:
+        logger.exception(f"Failed to send a batch of {len(messages)} messages to group {group}")
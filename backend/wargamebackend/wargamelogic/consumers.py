@@ -1,26 +1,28 @@
-import json
-from django.core.cache import cache
-from channels.db import database_sync_to_async
+import asyncio
+import logging
+import time
+import uuid
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from wargamelogic.models.static import Team, Role
+from wargamelogic.coalescing import coalesce_message
+from wargamelogic.event_log import EventLog
+from wargamelogic.messages import (
+    MSGPACK_SUBPROTOCOL, encode_message, encode_message_bytes, text_to_message_bytes, decode_message,
+    group_send_message
+)
+from wargamelogic.outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, message_key
+from wargamelogic.presence import PresenceStore
+from wargamelogic.rate_limit import RateLimiter
+from wargamelogic.role_context import aload_role_context
+from wargamelogic.registry import MessageError, MessageRegistry
+from wargamelogic.rpc import acall_view, aunits_in_game
+from wargamelogic.static_cache import aget_static_catalog
+from wargamelogic.topology import (
+    channel_pair_name, transfer_pair_name, team_role_group
+)
+from wargamelogic.views import patch
 
 
-teams_cache = None
-roles_cache = None
-
-@database_sync_to_async
-def load_data():
-    global teams_cache
-    global roles_cache
-
-    if teams_cache is None:
-        teams_cache = list(Team.objects.all())
-
-    if roles_cache is None:
-        roles_cache = list(Role.objects.select_related("branch").all())
-
-    return teams_cache, roles_cache
-
 # You don't need to understand this code to be able to use the WebSocket.
 # What you need to know is that any message sent over the WebSocket should be an object
 # Containing "channel", "action", and "data" properties.
@@ -31,12 +33,24 @@ def load_data():
 # "data" is an object that can contain whatever kind of data you want,
 # Though typically it matches the shape of a record in one of the database's tables,
 # Or an array of such records.
+# Messages are JSON text by default; see messages.py for sending them as MessagePack instead.
 
 # You should only need to add to this code if you want
 # your message to be sent to a specific user in your game rather than everyone in your game.
 # That can be done by creating a handler function for your specific channel and action.
 
+# The handlers for specific channel/action messages, see the handlers section below.
+registry = MessageRegistry()
+
+logger = logging.getLogger(__name__)
+
 class GameConsumer(AsyncWebsocketConsumer):
+    # Messages that are replies to one user's request, so aren't worth replaying
+    # to them after they reconnect. Every other message sent to a group is logged in the game's EventLog.
+    unlogged_messages = {
+        ("users", "list"),
+    }
+
     # A user must be logged-in to connect to the WebSocket.
     # If successful, they're added to two groups,
     # One with everyone in their game, and one for just this game and user.
@@ -51,12 +65,28 @@ class GameConsumer(AsyncWebsocketConsumer):
         self.join_code = self.scope["url_route"]["kwargs"]["join_code"]
         self.game_group = f"game_{self.join_code}"
         self.user_group = f"game_{self.join_code}_user_{user.id}"
+        self.presence = PresenceStore(self.join_code)
+        self.event_log = EventLog(self.join_code)
+        self.groups = set()
+        self.role_context = None
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
+        self.rate_limiter = RateLimiter(
+            settings.WEBSOCKET_RATE_LIMIT,
+            settings.WEBSOCKET_ACTION_RATE_LIMIT,
+            settings.WEBSOCKET_ACTION_RATE_LIMITS
+        )
 
-        await self.channel_layer.group_add(self.game_group, self.channel_name)
-        await self.channel_layer.group_add(self.user_group, self.channel_name)
+        await self.join_groups([self.game_group, self.user_group])
 
-        print(f"{user.username} connected to game '{self.join_code}'.")
-        await self.accept()
+        logger.info(f"{user.username} connected to game '{self.join_code}'.", extra=self.log_fields())
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
+
+        self.outbound = OutboundQueue(
+            self.send,
+            settings.WEBSOCKET_OUTBOUND_QUEUE_MAXLEN,
+            settings.WEBSOCKET_SLOW_CONSUMER_POLICY
+        )
+        self.outbound_task = asyncio.create_task(self.outbound.run())
 
     async def disconnect(self, close_code):
         user = self.scope["user"]
@@ -64,72 +94,281 @@ class GameConsumer(AsyncWebsocketConsumer):
         if not hasattr(self, "join_code"):
             return
 
-        redis_client = get_redis_client()
-        role_key = f"game_{self.join_code}_role_instances"
-        role_instance_json = redis_client.hget(role_key, user.id)
+        if hasattr(self, "outbound_task"):
+            self.outbound_task.cancel()
 
-        if role_instance_json:
-            role_instance = json.loads(role_instance_json)
-            redis_client.hdel(role_key, user.id)
+        if hasattr(self, "heartbeat_task"):
+            self.heartbeat_task.cancel()
 
-            await self.channel_layer.group_send(
-                self.game_group,
-                {
-                    "type": "handle.message",
-                    "channel": "users",
-                    "action": "leave",
-                    "data": role_instance,
-                }
-            )
+        role_instance = await self.presence.remove(user.id)
 
-        await self.channel_layer.group_discard(self.game_group, self.channel_name)
-        await self.channel_layer.group_discard(self.user_group, self.channel_name)
-        for group in getattr(self, "channel_groups", []):
-            await self.channel_layer.group_discard(group, self.channel_name)
-        for group in getattr(self, "transfer_groups", []):
-            await self.channel_layer.group_discard(group, self.channel_name)
+        if role_instance:
+            await self.send_to_group(self.game_group, "users", "leave", role_instance)
 
-        print(f"{user.username} disconnected from game '{self.join_code}'.")
+        await self.leave_groups(self.groups)
+
+        logger.info(f"{user.username} disconnected from game '{self.join_code}'.", extra=self.log_fields())
 
     # when sending a message over a WebSocket in the browser,
     # it gets sent to this function to handle it, which then sends the message
     # to the correct group.
     # flow: frontend sender's socket.send() -> backend sender's receive()
     # -> backend receiver's handle_message() -> frontend receiver's socket.onmessage("message", ...)
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
-        text_data JSON format:
+        text_data JSON format (or bytes_data MessagePack format, with the msgpack subprotocol):
         {
             "channel": "communications" | "points" | "turn" | "units" | "users" | ...,
             "action": "send" | "start" | "move" | ...,
             "data": {...}
         }
         """
-        event = json.loads(text_data)
+        try:
+            event = decode_message(text_data, bytes_data)
+
+        except ValueError:
+            if not await self.throttle(None, None, {}):
+                await self.send_error(None, None, {}, "could not decode message")
+            return
+
+        if not isinstance(event, dict):
+            if not await self.throttle(None, None, {}):
+                await self.send_error(None, None, {}, "message must be an object")
+            return
+
         channel = event.get("channel", "default")
         action = event.get("action", "unknown")
         data = event.get("data", {})
 
+        # They're used as keys below, which a list or object can't be.
+        if not isinstance(channel, str) or not isinstance(action, str):
+            if not await self.throttle(None, None, {}):
+                await self.send_error(None, None, data, "channel and action must be strings")
+            return
+
+        # Checked before doing anything with the message, so a flood of them can't keep Redis busy.
+        if await self.throttle(channel, action, data):
+            return
+
         target_group = self.game_group
         send_data = data
 
-        handler_name = f"handle_{channel}_{action}"
-        handler = getattr(self, handler_name, None)
+        handler = registry.get(channel, action)
 
         if handler:
-            target_group = None
-            target_group, send_data = await handler(data)
+            error = handler.validate(data)
 
-        if target_group:
-            await self.channel_layer.group_send(
-                target_group,
-                {
-                    "type": "handle.message",
-                    "channel": channel,
-                    "action": action,
-                    "data": send_data,
-                }
-            )
+            if error is None:
+                started_at = time.perf_counter()
+
+                try:
+                    target_group, send_data = await handler.method(self, data)
+
+                except MessageError as e:
+                    error = str(e)
+
+                self.log_handled(handler.method.__name__, channel, action, time.perf_counter() - started_at)
+
+            if error is not None:
+                await self.send_error(channel, action, data, error)
+                return
+
+        if not target_group:
+            return
+
+        tick = settings.WEBSOCKET_COALESCED_CHANNELS.get(channel)
+
+        if tick:
+            coalesce_message(self.send_to_group, target_group, channel, action, send_data, tick)
+        else:
+            await self.send_to_group(target_group, channel, action, send_data)
+
+    # Adds this connection to every one of the groups.
+    # If the channel layer supports it, this is done in one go
+    # rather than with a separate round trip to Redis for each group.
+    async def join_groups(self, groups):
+        groups = [group for group in groups if group not in self.groups]
+
+        if hasattr(self.channel_layer, "group_add_many"):
+            await self.channel_layer.group_add_many(groups, self.channel_name)
+        else:
+            for group in groups:
+                await self.channel_layer.group_add(group, self.channel_name)
+
+        self.groups.update(groups)
+
+    # Removes this connection from every one of the groups.
+    async def leave_groups(self, groups):
+        groups = [group for group in groups if group in self.groups]
+
+        if hasattr(self.channel_layer, "group_discard_many"):
+            await self.channel_layer.group_discard_many(groups, self.channel_name)
+        else:
+            for group in groups:
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+        self.groups.difference_update(groups)
+
+    # Sends a message to every consumer in a group, logging it in the game's EventLog first.
+    # Logged messages are numbered and sent in one step, so they're sent in sequence order (see event_log.py).
+    async def send_to_group(self, group, channel, action, data):
+        text = encode_message(channel, action, data)
+
+        if (channel, action) in self.unlogged_messages:
+            await group_send_message(self.channel_layer, group, channel, action, data, None, text)
+            return
+
+        async with self.event_log.lock:
+            seq = await self.event_log.append(group, text)
+            await group_send_message(self.channel_layer, group, channel, action, data, seq, text)
+
+    # Sends a message to every consumer in each of the groups, in order.
+    async def send_to_groups(self, groups, channel, action, data):
+        for group in groups:
+            await self.send_to_group(group, channel, action, data)
+
+    # The groups that a communications or points message from this user to recipient,
+    # a (team name, role name) pair, is sent to, or None if they aren't allowed to send it to them.
+    # See WEBSOCKET_ROUTING in settings.py.
+    def recipient_groups(self, channel, recipient):
+        sender = self.role_context.key
+
+        if settings.WEBSOCKET_ROUTING == "pairs":
+            if channel == "communications":
+                group = f"game_{self.join_code}_channel_{channel_pair_name(sender, recipient)}"
+            else:
+                group = f"game_{self.join_code}_transfer_{transfer_pair_name(sender, recipient)}"
+
+            return [group] if group in self.groups else None
+
+        if channel == "communications":
+            allowed = self.role_topology.can_communicate(sender, recipient)
+        else:
+            allowed = self.role_topology.can_transfer(sender, recipient)
+
+        if not allowed:
+            return None
+
+        # Both ends of the conversation see the message, and a user messaging their own role only gets it once.
+        return list(dict.fromkeys([
+            self.team_role_group,
+            team_role_group(self.join_code, *recipient),
+        ]))
+
+    # Sends a message to just this connection's browser, after the ones already queued for it (see outbound.py).
+    async def send_message(self, channel, action, data, seq=None):
+        if self.use_msgpack:
+            frame = {"bytes_data": encode_message_bytes(channel, action, data, seq)}
+        else:
+            frame = {"text_data": encode_message(channel, action, data, seq)}
+
+        await self.outbound.put_wait(frame)
+
+    # The fields that every log record about this connection is tagged with, see wargamebackend/log.py.
+    def log_fields(self, **fields):
+        return {"join_code": self.join_code, "user_id": self.scope["user"].id, **fields}
+
+    # Logs how long a handler took, as a warning if it was slow.
+    def log_handled(self, handler_name, channel, action, duration):
+        level = logging.WARNING if duration > settings.SLOW_LOG_SECONDS else logging.DEBUG
+
+        if logger.isEnabledFor(level):
+            logger.log(level, f"{handler_name} handled a message in game '{self.join_code}'.", extra=self.log_fields(
+                handler=handler_name, channel=channel, action=action, duration_ms=round(duration * 1000, 3)
+            ))
+
+    # Tells this connection's browser that a message it sent was refused, and why.
+    # {
+    #     channel: string | null;    (of the refused message)
+    #     action: string | null;
+    #     detail: string;
+    #     request_id?: string;       (if the refused message had one)
+    # }
+    async def send_error(self, channel, action, data, detail):
+        user = self.scope["user"]
+        logger.warning(
+            f"{user.username} sent a message that was refused in game '{self.join_code}' ({channel}.{action}): {detail}",
+            extra=self.log_fields(channel=channel, action=action)
+        )
+
+        error = {
+            "channel": channel,
+            "action": action,
+            "detail": detail,
+        }
+
+        if isinstance(data, dict) and "request_id" in data:
+            error["request_id"] = data["request_id"]
+
+        await self.send_message("errors", "invalid", error)
+
+    # Returns whether the message should be dropped for being sent too fast (see rate_limit.py),
+    # telling the browser if it's the first one dropped in a row.
+    async def throttle(self, channel, action, data):
+        retry_after = self.rate_limiter.check(channel, action)
+
+        if self.rate_limiter.should_notify(retry_after):
+            await self.send_throttled(channel, action, data, retry_after)
+
+        return bool(retry_after)
+
+    # Tells this connection's browser that it's sending messages too fast,
+    # and that its messages are being dropped until retry_after seconds have passed.
+    # {
+    #     channel: string;    (of the first dropped message)
+    #     action: string;
+    #     retry_after: number;
+    #     request_id?: string;
+    # }
+    async def send_throttled(self, channel, action, data, retry_after):
+        user = self.scope["user"]
+        logger.warning(
+            f"{user.username} is sending messages too fast in game '{self.join_code}' ({channel}.{action}).",
+            extra=self.log_fields(channel=channel, action=action)
+        )
+
+        error = {
+            "channel": channel,
+            "action": action,
+            "retry_after": round(retry_after, 3),
+        }
+
+        if isinstance(data, dict) and "request_id" in data:
+            error["request_id"] = data["request_id"]
+
+        await self.send_message("errors", "throttled", error)
+
+    # Returns who this user is in the game, loading their RoleInstance the first time it's needed.
+    async def get_role_context(self):
+        if self.role_context is None:
+            self.role_context = await aload_role_context(self.scope["user"], self.join_code)
+
+            if self.role_context is None:
+                raise MessageError(f"{self.scope['user'].username} does not have a role in game '{self.join_code}'.")
+
+        return self.role_context
+
+    # Returns who this user is in the game, refusing the message if they haven't joined it yet.
+    def get_joined_role_context(self, doing):
+        if not hasattr(self, "team_group"):
+            raise MessageError(f"{self.scope['user'].username} tried {doing} in game '{self.join_code}' before joining it.")
+
+        return self.role_context
+
+    # Once the user has joined, keeps their presence entry alive until they disconnect.
+    # If this worker dies, the heartbeats stop and the entry is swept away by another connection.
+    async def send_heartbeats(self):
+        user = self.scope["user"]
+
+        while True:
+            await asyncio.sleep(settings.WEBSOCKET_PRESENCE_HEARTBEAT_INTERVAL)
+            stale_role_instances = await self.presence.heartbeat(user.id)
+            await self.announce_stale_users(stale_role_instances)
+
+    # Tells the game that users whose connections died without disconnecting have left.
+    async def announce_stale_users(self, role_instances):
+        for role_instance in role_instances:
+            await self.send_to_group(self.game_group, "users", "leave", role_instance)
 
     # when receiving a message over a WebSocket from a group,
     # it gets handled by this function,
@@ -145,13 +384,37 @@ class GameConsumer(AsyncWebsocketConsumer):
             }
         });
         """
-        await self.send(
-            text_data=json.dumps({
-                "channel": event["channel"],
-                "action": event["action"],
-                "data": event["data"],
-            })
-        )
+        # The connection is already being closed for falling behind.
+        if self.outbound.overflowed:
+            return
+
+        # Events that were sent without being pre-encoded still carry the message's fields.
+        text_data = event.get("text")
+
+        if self.use_msgpack:
+            if text_data is None:
+                bytes_data = encode_message_bytes(event["channel"], event["action"], event["data"])
+            else:
+                bytes_data = text_to_message_bytes(text_data)
+
+            frame = {"bytes_data": bytes_data}
+
+        else:
+            if text_data is None:
+                text_data = encode_message(event["channel"], event["action"], event["data"])
+
+            frame = {"text_data": text_data}
+
+        # Messages that a later one replaces can be dropped if this browser can't keep up.
+        if "data" in event:
+            key = message_key(event["channel"], event["action"], event["data"])
+        else:
+            key = event.get("key")
+
+        if not self.outbound.put(frame, key):
+            user = self.scope["user"]
+            logger.warning(f"{user.username} could not keep up with game '{self.join_code}' and was disconnected.", extra=self.log_fields())
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
 
     # ---------------- #
     # handlers         #
@@ -160,86 +423,78 @@ class GameConsumer(AsyncWebsocketConsumer):
     # By default, messages are simply broadcast to everyone in the game,
     # But with a handler you can make it send a message to only a specific user,
     # and perform side-effects, or change the data that is sent.
+    # Handlers are registered with @registry.handler(channel, action, schema),
+    # where the schema lists the properties the message's data must have (see registry.py).
     # These should return the group that the message should be sent to,
     # Whether the group containing all the users in this game,
     # The group containing just a specific user in the game,
-    # Or if you raise an exception it won't be sent to anybody.
+    # Or None to send it to nobody.
+    # If you raise a MessageError it won't be sent to anybody, and the sender is sent an errors.invalid message.
+    # Who the sender is (their team, role and RoleInstance) comes from self.role_context,
+    # which is loaded from the database, never from the message.
+    @registry.handler("users", "list")
     async def handle_users_list(self, data):
         """
-        data: RoleInstance
+        data: {}
+        Sends this user the RoleInstances of the users connected to the game on their team,
+        or on every team if they're a Gamemaster.
         """
-        user = self.scope["user"]
-
-        if data["user"]["username"] != user.username:
-            raise Exception(f"{user.username} tried requesting the user list in game '{self.join_code}' but as the wrong user or did not provide role data.")
-
-        redis_client = get_redis_client()
-        role_instances_key = f"game_{self.join_code}_role_instances"
-
-        role_instances = {
-            int(uid): json.loads(val)
-            for uid, val in redis_client.hgetall(role_instances_key).items()
-        }
+        role_context = await self.get_role_context()
 
-        user_team = data["team_instance"]["team"]["name"]
+        if role_context.is_gamemaster:
+            return self.user_group, await self.presence.all()
 
-        if user_team == "Gamemasters":
-            return self.user_group, list(role_instances.values())
-
-        same_team_role_instances = [
-            ri for ri in role_instances.values()
-            if ri["team_instance"]["team"]["name"] == user_team
-        ]
-
-        return self.user_group, same_team_role_instances
+        return self.user_group, await self.presence.team(role_context.team_name)
 
+    @registry.handler("users", "join")
     async def handle_users_join(self, data):
         """
-        data: RoleInstance
+        data: {}
+        Sends this user's RoleInstance to their team.
         """
         user = self.scope["user"]
-        user_username = data["user"]["username"]
+        role_context = await self.get_role_context()
 
-        if user_username != user.username:
-            raise Exception(f"{user.username} tried joining as {user_username} in game '{self.join_code}'.")
+        added, stale_role_instances = await self.presence.add(user.id, role_context.role_instance)
+        await self.announce_stale_users(stale_role_instances)
 
-        redis_client = get_redis_client()
-        role_key = f"game_{self.join_code}_role_instances"
+        if not added:
+            raise MessageError(f"{user.username} tried joining game '{self.join_code}', a game they had already joined.")
 
-        if redis_client.hexists(role_key, user.id):
-            raise Exception(f"{user_username} tried joining game '{self.join_code}', a game they had already joined.")
+        self.heartbeat_task = asyncio.create_task(self.send_heartbeats())
 
-        teams, roles = await load_data()
-        user_team = data["team_instance"]["team"]["name"]
+        self.role_topology = role_topology = (await aget_static_catalog()).role_topology
+        user_team, user_role = role_context.key
 
         self.team_group = f"game_{self.join_code}_team_{user_team}".replace(" ", "")
 
-        if user_team == "Gamemasters":
-            for team in teams:
-                team_group = f"game_{self.join_code}_team_{team.name}".replace(" ", "")
-                await self.channel_layer.group_add(team_group, self.channel_name)
+        if role_context.is_gamemaster:
+            team_groups = [
+                f"game_{self.join_code}_team_{team_name}".replace(" ", "")
+                for team_name in role_topology.team_names
+            ]
         else:
-            await self.channel_layer.group_add(self.team_group, self.channel_name)
+            team_groups = [self.team_group]
 
-        user_role = data["role"]["name"]
-        self.team_role_group = f"game_{self.join_code}_team_role_{user_team}{user_role}".replace(" ", "")
-        await self.channel_layer.group_add(self.team_role_group, self.channel_name)
+        self.team_role_group = team_role_group(self.join_code, user_team, user_role)
+        groups = team_groups + [self.team_role_group]
 
-        self.channel_groups = get_user_channel_groups(self.join_code, teams, roles, data)
-        for group in self.channel_groups:
-            await self.channel_layer.group_add(group, self.channel_name)
+        if settings.WEBSOCKET_ROUTING == "pairs":
+            groups += role_topology.channel_groups(self.join_code, user_team, user_role)
+            groups += role_topology.transfer_groups(self.join_code, user_team, user_role)
 
-        self.transfer_groups = get_user_transfer_groups(self.join_code, teams, roles, data)
-        for group in self.transfer_groups:
-            await self.channel_layer.group_add(group, self.channel_name)
+        await self.join_groups(groups)
 
-        redis_client.hset(role_key, user.id, json.dumps(data))
-
-        return self.team_group, data
+        return self.team_group, role_context.role_instance
 
+    @registry.handler("users", "ready")
     async def handle_users_ready(self, data):
+        self.get_joined_role_context("getting ready")
         return self.team_group, data
 
+    @registry.handler("role_instances", "delete", {
+        "id": (int, str),
+    })
     async def handle_role_instances_delete(self, data):
         """
         data: RoleInstance
@@ -248,172 +503,258 @@ class GameConsumer(AsyncWebsocketConsumer):
 
         if not recipient_id:
             user = self.scope["user"]
-            raise Exception(f"{user.username} did not provide the id of the user whose role they're deleting.")
+            raise MessageError(f"{user.username} did not provide the id of the user whose role they're deleting.")
 
         target_group = f"game_{self.join_code}_user_{recipient_id}"
         return target_group, data
 
+    @registry.handler("communications", "send", {
+        "recipient_team_name": str,
+        "recipient_role_name": str,
+    })
     async def handle_communications_send(self, data):
         """
-        data: Message
+        data: Message, without sender_role_instance, which is filled in with this user's RoleInstance
         """
-        sender_team_name = data["sender_role_instance"]["team_instance"]["team"]["name"].replace(" ", "")
-        sender_role_name = data["sender_role_instance"]["role"]["name"].replace(" ", "")
+        role_context = self.get_joined_role_context("sending a message")
 
-        recipient_team_name = data["recipient_team_name"].replace(" ", "")
-        recipient_role_name = data["recipient_role_name"].replace(" ", "")
+        recipient = (data["recipient_team_name"], data["recipient_role_name"])
+        target_groups = self.recipient_groups("communications", recipient)
 
-        a, b = sorted([
-            f"{sender_team_name}{sender_role_name}",
-            f"{recipient_team_name}{recipient_role_name}"
-        ])
-        target_group = f"game_{self.join_code}_channel_{a}_{b}"
-
-        if target_group not in self.channel_groups:
+        if target_groups is None:
             user = self.scope["user"]
-            raise Exception(f"User {user.username} on team {sender_team_name} with role {sender_role_name} is not in group {target_group}")
+            raise MessageError(f"User {user.username} on team {role_context.team_name} with role {role_context.role_name} can't message {recipient[0]} {recipient[1]}s.")
 
-        return target_group, data
+        await self.send_to_groups(target_groups, "communications", "send", {**data, "sender_role_instance": role_context.role_instance})
+        return None, None
 
+    @registry.handler("points", "send", {
+        "recipient_team_name": str,
+        "recipient_role_name": str,
+    })
     async def handle_points_send(self, data):
         """
-        data: Message
+        data: Message, without sender_role_instance, which is filled in with this user's RoleInstance
         """
-        sender_team_name = data["sender_role_instance"]["team_instance"]["team"]["name"]
-        sender_role_name = data["sender_role_instance"]["role"]["name"]
-
-        recipient_team_name = data["recipient_team_name"]
-        recipient_role_name = data["recipient_role_name"]
+        role_context = self.get_joined_role_context("sending supply points")
 
-        target_group = f"game_{self.join_code}_transfer_{sender_team_name}{sender_role_name}_{recipient_team_name}{recipient_role_name}".replace(" ", "")
+        recipient = (data["recipient_team_name"], data["recipient_role_name"])
+        target_groups = self.recipient_groups("points", recipient)
 
-        if target_group not in self.transfer_groups:
+        if target_groups is None:
             user = self.scope["user"]
-            raise Exception(f"User {user.username} on team {sender_team_name} with role {sender_role_name} is not in group {target_group}")
+            raise MessageError(f"User {user.username} on team {role_context.team_name} with role {role_context.role_name} can't send supply points to {recipient[0]} {recipient[1]}s.")
 
-        return target_group, data
+        await self.send_to_groups(target_groups, "points", "send", {**data, "sender_role_instance": role_context.role_instance})
+        return None, None
+
+    @registry.handler("events", "replay", {
+        "last_seq": int,
+    })
+    async def handle_events_replay(self, data):
+        """
+        data: {
+            last_seq: number;
+        }
+        Sends this user the messages they missed since the message numbered last_seq,
+        or an events.resync message if they missed too many and must refetch the game's state.
+        Should be sent after users.join, so that the user is in all of the groups they'll be sent messages in.
+        last_seq is the highest seq the client received, since the messages sent from a process arrive in sequence order.
+        With several processes, messages sent from different ones can arrive out of order, and a client that disconnected
+        in between may have missed one numbered below the highest it received. Clients of such a deployment should replay
+        from below the lowest seq they received out of order (or a little below the highest, if none were),
+        skipping the messages they receive again.
+        """
+        last_seq = data["last_seq"]
 
+        if last_seq < 0:
+            username = self.scope["user"].username
+            raise MessageError(f"User {username} asked to replay events in game '{self.join_code}' without a valid last_seq.")
+
+        messages = await self.event_log.read_since(last_seq, self.groups)
+
+        if messages is None:
+            await self.send_message("events", "resync", {"last_seq": last_seq})
+            return None, None
+
+        for seq, channel, action, message_data in messages:
+            await self.send_message(channel, action, message_data, seq)
+
+        return None, None
+
+    @registry.handler("points", "spend", {
+        "supply_points": float,
+    })
     async def handle_points_spend(self, data):
         """
         data: {
-            team_name: string;
-            role_name: string;
             supply_points: number;
         }
+        Sent to the users with this user's team and role, with team_name and role_name filled in.
         """
-        sender_team_name = data["team_name"]
-        sender_role_name = data["role_name"]
-
-        target_group = self.team_role_group
+        role_context = self.get_joined_role_context("spending supply points")
 
-        if not hasattr(self, "team_role_group"):
-            username = self.scope["user"].username
-            raise Exception(f"User {username} on team {sender_team_name} with role {sender_role_name} is not in group {target_group}")
+        return self.team_role_group, {
+            **data,
+            "team_name": role_context.team_name,
+            "role_name": role_context.role_name,
+        }
 
-        return target_group, data
+    # ---------------- #
+    # actions          #
+    # ---------------- #
+    # Game actions that change the database, run over the WebSocket instead of a separate HTTP request.
+    # Each one calls the same REST API endpoint the HTTP request would (see rpc.py),
+    # replies to the sender with an actions.result message, and if the action succeeded,
+    # sends the result to the users who need it, so the browser doesn't have to.
+    # Every action's data has a request_id, which is sent back in the actions.result message
+    # so the browser can tell which of its actions the result is for:
+    # {
+    #     request_id: string;
+    #     status: number;  (the HTTP status code the endpoint responded with)
+    #     data: {...};     (the endpoint's response)
+    # }
+    # These should be sent after users.join.
+
+    # Runs a REST API endpoint as this user and replies with its result.
+    # Returns the endpoint's response if it succeeded, or None if it didn't.
+    async def run_action(self, data, view, body, **kwargs):
+        status_code, response_data = await acall_view(view, self.scope["user"], body, **kwargs)
+
+        await self.send_message("actions", "result", {
+            "request_id": data.get("request_id"),
+            "status": status_code,
+            "data": response_data,
+        })
+
+        return response_data if status_code < 400 else None
+
+    # Raises a MessageError unless all of the UnitInstances are in this game,
+    # so an action can't change another game's units and announce it to this one.
+    async def check_units_in_game(self, *unit_instance_ids):
+        if not await aunits_in_game(self.join_code, *unit_instance_ids):
+            raise MessageError(f"{self.scope['user'].username} tried acting on units that aren't in game '{self.join_code}'.")
+
+    @registry.handler("actions", "move", {
+        "unit_instance_id": int,
+        "row": int,
+        "column": int,
+    })
+    async def handle_actions_move(self, data):
+        """
+        data: {
+            request_id: string;
+            unit_instance_id: number;
+            row: number;
+            column: number;
+        }
+        On success, the moved UnitInstance is sent to everyone in the game in a units.move message.
+        """
+        await self.check_units_in_game(data["unit_instance_id"])
 
-# ---------------- #
-# Redis helpers    #
-# ---------------- #
-def get_redis_client():
-    """Get the synchronous Redis client."""
-    return cache.client.get_client(write=True)
-
-# -------------------- #
-# helper functions     #
-# -------------------- #
-def get_user_channel_groups(join_code, teams, roles, role_instance):
-    user_role_name = role_instance["role"]["name"]
-    user_team_name = role_instance["team_instance"]["team"]["name"]
-    gamemaster_team_name = "Gamemasters"
-
-    groups = []
-
-    if user_role_name == "Gamemaster":
-        groups += (
-            [(gamemaster_team_name, "Gamemaster")] +
-            [(t.name, r.name) for r in roles if r.name != "Gamemaster" for t in teams if t.name != gamemaster_team_name]
+        unit_instance = await self.run_action(
+            data, patch.move_unit_instance, {},
+            pk=data["unit_instance_id"], row=data["row"], column=data["column"]
         )
 
-    if user_role_name == "Ambassador":
-        groups += (
-            [(gamemaster_team_name, "Gamemaster")] +
-            [(t.name, user_role_name) for t in teams if t.name != gamemaster_team_name] +
-            [(user_team_name, "Combatant Commander")] +
-            [(user_team_name, r.name) for r in roles if r.is_chief_of_staff]
-        )
+        if unit_instance is not None:
+            await self.send_to_group(self.game_group, "units", "move", unit_instance)
 
-    if user_role_name == "Combatant Commander":
-        groups += (
-            [(user_team_name, user_role_name), (gamemaster_team_name, "Gamemaster"), (user_team_name, "Ambassador")] +
-            [(user_team_name, r.name) for r in roles if r.is_chief_of_staff]
-        )
+        return None, None
 
-    if role_instance["role"]["is_chief_of_staff"]:
-        groups += (
-            [(user_team_name, user_role_name), (gamemaster_team_name, "Gamemaster"), (user_team_name, "Combatant Commander")] +
-            [(user_team_name, r.name) for r in roles if r.is_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
+    @registry.handler("actions", "attack", {
+        "attacker_id": int,
+        "target_id": int,
+        "attack_name": str,
+    })
+    async def handle_actions_attack(self, data):
+        """
+        data: {
+            request_id: string;
+            attacker_id: number;
+            target_id: number;
+            attack_name: string;
+        }
+        On success, the result of the attack is sent to everyone in the game in a units.attack message.
+        """
+        await self.check_units_in_game(data["attacker_id"], data["target_id"])
+
+        result = await self.run_action(
+            data, patch.use_attack,
+            {
+                "attacker_id": data["attacker_id"],
+                "target_id": data["target_id"],
+                "attack_name": data["attack_name"],
+            },
+            pk=data["attacker_id"], attack_name=data["attack_name"]
         )
 
-    if role_instance["role"]["is_commander"]:
-        groups += (
-            [(gamemaster_team_name, "Gamemaster")] +
-            [(user_team_name, r.name) for r in roles if r.is_chief_of_staff and r.branch.name == role_instance["role"]["branch"]["name"]] +
-            [(user_team_name, r.name) for r in roles if r.is_commander and r.branch.name == role_instance["role"]["branch"]["name"]] +
-            [(user_team_name, r.name) for r in roles if r.is_vice_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
-        )
+        if result is not None:
+            await self.send_to_group(self.game_group, "units", "attack", result)
+
+        return None, None
+
+    @registry.handler("actions", "transfer", {
+        "transfers": list,
+    })
+    async def handle_actions_transfer(self, data):
+        """
+        data: {
+            request_id: string;
+            transfers: [
+                {
+                    team_name: string;
+                    role_name: string;
+                    supply_points: number;
+                },
+                ...
+            ];
+        }
+        Supply points are sent from the role this user joined as.
+        On success, each transfer is sent as a points.send message to its transfer group,
+        and announced in a system communications.send message to the sender and recipient's channel.
+        """
+        role_context = self.get_joined_role_context("transferring supply points")
+        sender_team_name, sender_role_name = role_context.key
 
-    if role_instance["role"]["is_vice_commander"]:
-        groups += (
-            [(gamemaster_team_name, "Gamemaster")] +
-            [(user_team_name, r.name) for r in roles if r.is_commander and r.branch.name == role_instance["role"]["branch"]["name"]] +
-            [(user_team_name, r.name) for r in roles if r.is_vice_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
+        transfers = await self.run_action(
+            data, patch.send_points, {"transfers": data.get("transfers")},
+            join_code=self.join_code, team_name=sender_team_name, role_name=sender_role_name
         )
 
-    channel_groups = sorted([
-        f"game_{join_code}_channel_{teamRole1}_{teamRole2}"
-        for team, role in groups
-        for teamRole1, teamRole2 in [sorted([f"{user_team_name}{user_role_name}".replace(" ", ""), f"{team}{role}".replace(" ", "")])]
-    ])
-
-    return channel_groups
-
-def get_user_transfer_groups(join_code, teams, roles, role_instance):
-    user_role_name = role_instance["role"]["name"]
-    user_team_name = role_instance["team_instance"]["team"]["name"]
-    gamemaster_team_name = "Gamemasters"
-
-    transfer_to_groups = []
-    transfer_from_groups = []
-
-    if user_role_name == "Gamemaster":
-        transfer_to_groups += [(t.name, r.name) for r in roles if r.name != "Gamemaster" for t in teams if t.name != gamemaster_team_name]
-    else:
-        transfer_from_groups += [(gamemaster_team_name, "Gamemaster")]
-
-    if user_role_name == "Combatant Commander":
-        transfer_to_groups += [(user_team_name, r.name) for r in roles if r.is_chief_of_staff]
-
-    if role_instance["role"]["is_chief_of_staff"]:
-        transfer_to_groups += [(user_team_name, r.name) for r in roles if r.is_logistics and r.is_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
-        transfer_from_groups += [(user_team_name, r.name) for r in roles if r.name == "Combatant Commander"]
-
-    if role_instance["role"]["is_commander"] and role_instance["role"]["is_logistics"]:
-        transfer_to_groups += [(user_team_name, r.name) for r in roles if r.is_logistics and r.is_vice_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
-        transfer_from_groups += [(user_team_name, r.name) for r in roles if r.is_chief_of_staff and r.branch.name == role_instance["role"]["branch"]["name"]]
-
-    if role_instance["role"]["is_vice_commander"] and role_instance["role"]["is_logistics"]:
-        transfer_from_groups += [(user_team_name, r.name) for r in roles if r.is_commander and r.branch.name == role_instance["role"]["branch"]["name"]]
-
-    transfer_groups = (
-        sorted([
-            f"game_{join_code}_transfer_{user_team_name}{user_role_name}_{team}{role}".replace(" ", "")
-            for team, role in transfer_to_groups
-        ]) +
-        sorted ([
-            f"game_{join_code}_transfer_{team}{role}_{user_team_name}{user_role_name}".replace(" ", "")
-            for team, role in transfer_from_groups
-        ])
-    )
-
-    return transfer_groups
+        if transfers is None:
+            return None, None
+
+        username = self.scope["user"].username
+        sender_display_name = sender_role_name if role_context.is_gamemaster else f"{sender_team_name} {sender_role_name}"
+
+        for transfer in transfers:
+            recipient = (transfer["team_instance"]["team"]["name"], transfer["role"]["name"])
+            message = {
+                "sender_role_instance": role_context.role_instance,
+                "recipient_team_name": recipient[0],
+                "recipient_role_name": recipient[1],
+                "timestamp": int(time.time() * 1000),
+            }
+
+            await self.send_to_groups(
+                self.recipient_groups("points", recipient) or [],
+                "points", "send",
+                {**message, "id": str(uuid.uuid4()), "text": str(transfer["supply_points"])}
+            )
+
+            channel_groups = self.recipient_groups("communications", recipient)
+
+            if channel_groups:
+                await self.send_to_groups(
+                    channel_groups,
+                    "communications", "send",
+                    {
+                        **message,
+                        "id": str(uuid.uuid4()),
+                        "type": "system",
+                        "text": f"{sender_display_name} {username} transferred {transfer['supply_points']} supply points to {recipient[0]} {recipient[1]}s.",
+                    }
+                )
+
+        return None, None
@@ -0,0 +1,102 @@
+# This file keeps a log of the messages sent to each game's groups over the WebSocket,
+# so a client that reconnects can be sent only the messages it missed
+# instead of refetching everything through the REST API.
+# Every logged message gets the next number in the game's sequence,
+# which is sent to clients in the message's "seq" property.
+# The log is a Redis Stream, game_<join_code>_events, whose entry ids are the sequence numbers,
+# and it's trimmed to roughly settings.WEBSOCKET_EVENT_LOG_MAXLEN entries.
+# The log and its sequence number expire settings.WEBSOCKET_EVENT_LOG_TTL seconds after the last message,
+# so finished games' logs don't stay in Redis forever. A client that reconnects to a game
+# that has been quiet for that long refetches its state, as it would if its messages had been trimmed.
+#
+# Consumers log and send each message while holding the game's lock on their process (see EventLog.lock),
+# so the messages sent from a process reach every client in sequence order, and a client that has seen
+# a message has seen every lower numbered one sent from that process.
+
+import asyncio
+import json
+import weakref
+from django.conf import settings
+from wargamelogic.redis_clients import get_async_game_redis_client, get_script
+
+
+# Numbers the message and adds it to the log in one step,
+# so that entries are always added in sequence order.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], seq .. '-0', 'group', ARGV[2], 'message', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return seq
+"""
+
+# Each running loop's locks, by join code, which are kept while some EventLog of the game holds its lock.
+_locks = weakref.WeakKeyDictionary()
+
+class EventLog:
+    def __init__(self, join_code):
+        self.join_code = join_code
+        self.seq_key = f"game_{join_code}_event_seq"
+        self.stream_key = f"game_{join_code}_events"
+        self._lock = None
+
+    @property
+    def lock(self):
+        """The game's lock on this process, to be held while a message is logged and sent."""
+        if self._lock is None:
+            locks = _locks.setdefault(asyncio.get_running_loop(), weakref.WeakValueDictionary())
+            self._lock = locks.get(self.join_code)
+
+            if self._lock is None:
+                self._lock = locks[self.join_code] = asyncio.Lock()
+
+        return self._lock
+
+    async def append(self, group, message):
+        """
+        Logs a message sent to the group, returning its sequence number.
+        message is the message encoded by encode_message without a seq (see messages.py),
+        which is also what's sent to the group, so it's only encoded once.
+        """
+        redis_client = get_async_game_redis_client(self.join_code)
+
+        return await get_script(redis_client, APPEND_SCRIPT)(
+            keys=[self.seq_key, self.stream_key],
+            args=[settings.WEBSOCKET_EVENT_LOG_MAXLEN, group, message, settings.WEBSOCKET_EVENT_LOG_TTL]
+        )
+
+    async def read_since(self, last_seq, groups):
+        """
+        Returns the messages sent to any of the groups after last_seq,
+        as (seq, channel, action, data) tuples in sequence order.
+        Returns None if some of those messages are no longer in the log,
+        in which case the client has to refetch the game's state instead.
+        """
+        redis_client = get_async_game_redis_client(self.join_code)
+
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(self.seq_key)
+            pipe.xrange(self.stream_key, min=f"{last_seq + 1}-0")
+            current_seq, entries = await pipe.execute()
+
+        current_seq = int(current_seq or 0)
+
+        if last_seq > current_seq:
+            return None
+
+        if last_seq < current_seq:
+            first_seq = int(entries[0][0].split("-")[0]) if entries else None
+
+            if first_seq != last_seq + 1:
+                return None
+
+        messages = []
+
+        for entry_id, fields in entries:
+            if fields["group"] not in groups:
+                continue
+
+            message = json.loads(fields["message"])
+            messages.append((int(entry_id.split("-")[0]), message["channel"], message["action"], message["data"]))
+
+        return messages
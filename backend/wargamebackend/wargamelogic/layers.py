@@ -0,0 +1,280 @@
+# This file defines the channel layer used by the WebSocket (see CHANNEL_LAYERS in settings.py).
+# It's the channels_redis layer with extra methods for adding a channel to,
+# or removing it from, many groups at once.
+# A Gamemaster joining a game belongs to dozens of groups,
+# and adding them one at a time costs one Redis round trip per group.
+# When it's given more than one Redis host, every group belonging to a game is kept on the
+# game's shard (see sharding.py), rather than each group being put on whichever host its name hashes to.
+#
+# With local_delivery on, group_send hands messages to consumers running in this process directly,
+# putting them in the buffer their receive() waits on, and only pushes messages through Redis
+# for consumers in other processes. Group membership is still kept in Redis, so every process knows
+# about every member. The messages that do come through Redis are read by one task for the whole process
+# and put in the same buffers, rather than by whichever consumer's receive() got there first,
+# which would keep that consumer waiting on Redis while its buffer filled up.
+# Messages sent to a group from another thread's event loop (e.g. a view using async_to_sync)
+# can't be put in the consumers' buffers, so they always go through Redis.
+# Only channels whose consumer is still receiving get messages put in their buffers:
+# a consumer that went away without leaving its groups stays in them until group_expiry,
+# and nothing would ever empty its buffer. Like the lists in Redis, each buffer holds at most
+# the channel's capacity, and messages to a full one are dropped.
+
+import asyncio
+import logging
+import time
+from collections import Counter, defaultdict
+from channels_redis.core import RedisChannelLayer
+from wargamelogic.sharding import HashRing, join_code_from_group
+from wargamelogic.redis_clients import get_script
+
+
+logger = logging.getLogger(__name__)
+
+# How many messages sent to groups by this process were handed over in-process, and how many through Redis,
+# along with how many messages for this process's channels were dropped, because nothing was receiving them
+# ("orphaned") or their buffer was full ("over_capacity").
+delivery_counters = Counter()
+
+# Pushes a message onto each channel's list that isn't full, the same way channels_redis's group_send does.
+GROUP_SEND_SCRIPT = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+class GameChannelLayer(RedisChannelLayer):
+    def __init__(self, *args, local_delivery=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_delivery = local_delivery
+        self._reader = None
+        # The channels of this process whose consumers are receiving messages.
+        self._receiving_channels = set()
+        self._game_ring = HashRing(host["address"] for host in self.hosts)
+
+        # Newer versions of redis-py give up reading from Redis after 5 seconds by default,
+        # which is as long as channels_redis blocks waiting for a message,
+        # so a quiet connection's receive could time out and take its consumer down with it.
+        for host in self.hosts:
+            host.setdefault("socket_timeout", self.brpop_timeout + 5)
+
+    def consistent_hash(self, value):
+        join_code = join_code_from_group(value)
+
+        if join_code is None:
+            return super().consistent_hash(value)
+
+        return self._game_ring.index(join_code)
+
+    def _groups_by_connection(self, groups):
+        """Splits group names up by the index of the Redis shard that holds them."""
+        groups_by_connection = defaultdict(list)
+
+        for group in groups:
+            assert self.require_valid_group_name(group), "Group name not valid"
+            groups_by_connection[self.consistent_hash(group)].append(group)
+
+        return groups_by_connection.items()
+
+    async def group_add_many(self, groups, channel):
+        """
+        Adds the channel name to every group, in one pipelined transaction per Redis shard.
+        """
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+        now = time.time()
+
+        for index, shard_groups in self._groups_by_connection(groups):
+            connection = self.connection(index)
+
+            async with connection.pipeline(transaction=True) as pipe:
+                for group in shard_groups:
+                    group_key = self._group_key(group)
+                    pipe.zadd(group_key, {channel: now})
+                    pipe.expire(group_key, self.group_expiry)
+
+                await pipe.execute()
+
+    async def group_discard_many(self, groups, channel):
+        """
+        Removes the channel name from every group, in one pipelined transaction per Redis shard.
+        """
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+
+        for index, shard_groups in self._groups_by_connection(groups):
+            connection = self.connection(index)
+
+            async with connection.pipeline(transaction=True) as pipe:
+                for group in shard_groups:
+                    pipe.zrem(self._group_key(group), channel)
+
+                await pipe.execute()
+
+    async def receive(self, channel):
+        """
+        Receives the first message that arrives on the channel,
+        from its buffer if local_delivery is on.
+        """
+        if not self.local_delivery or "!" not in channel:
+            return await super().receive(channel)
+
+        assert self.require_valid_channel_name(channel)
+        real_channel = self.non_local_name(channel)
+        assert real_channel.endswith(self.client_prefix + "!"), "Wrong client prefix"
+
+        self._start_reader(real_channel)
+        self._receiving_channels.add(channel)
+        self.receive_count += 1
+
+        try:
+            message = await self.receive_buffer[channel].get()
+
+        except asyncio.CancelledError:
+            # The consumer is gone, so nothing will read the rest of its buffer.
+            self._receiving_channels.discard(channel)
+            self.receive_buffer.pop(channel, None)
+            raise
+
+        finally:
+            self.receive_count -= 1
+
+        if channel in self.receive_buffer and self.receive_buffer[channel].empty():
+            del self.receive_buffer[channel]
+
+        return message
+
+    def _start_reader(self, real_channel):
+        """Starts the task reading this process's messages from Redis, unless it's already running."""
+        loop = asyncio.get_running_loop()
+
+        if self._reader is not None and not self._reader.done() and not self.receive_event_loop.is_closed():
+            if self.receive_event_loop is not loop:
+                raise RuntimeError("Two event loops are trying to receive() on one channel layer at once!")
+
+            return
+
+        self.receive_event_loop = loop
+        self._reader = loop.create_task(self._read(real_channel))
+
+    async def _read(self, real_channel):
+        """Puts every message sent through Redis to a channel of this process in the channel's buffer."""
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                # The layer was closed, or nothing on this process is receiving any more.
+                # The next receive() starts reading again.
+                if self._reader is not asyncio.current_task() or not self._receiving_channels:
+                    logger.info(f"Stopped reading messages from the channel layer: {e!r}")
+                    return
+
+                logger.exception(f"Could not read messages from the channel layer, retrying: {e!r}")
+                await asyncio.sleep(1)
+                continue
+
+            for channel in message_channel if isinstance(message_channel, list) else [message_channel]:
+                self._buffer(channel, message)
+
+    def _buffer(self, channel, message):
+        """Puts a message in the channel's buffer, unless nothing is receiving on the channel or its buffer is full."""
+        if channel not in self._receiving_channels:
+            delivery_counters["orphaned"] += 1
+            return False
+
+        buffer = self.receive_buffer[channel]
+
+        if buffer.qsize() >= self.get_capacity(channel):
+            delivery_counters["over_capacity"] += 1
+            return False
+
+        buffer.put_nowait(message)
+        return True
+
+    async def close_pools(self):
+        # Also called by flush().
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+        await super().close_pools()
+
+    def _is_local(self, channel):
+        """Whether the channel belongs to a consumer receiving on this layer, on the running event loop."""
+        return (
+            "!" in channel
+            and self.non_local_name(channel).endswith(self.client_prefix + "!")
+            and self._reader is not None
+            and self.receive_event_loop is asyncio.get_running_loop()
+        )
+
+    async def group_send(self, group, message):
+        """
+        Sends a message to every channel in the group,
+        handing it directly to the ones received on this process if local_delivery is on.
+        """
+        if not self.local_delivery:
+            return await super().group_send(group, message)
+
+        assert self.require_valid_group_name(group), "Group name not valid"
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+
+        # Discard expired members and read the rest in one round trip.
+        async with connection.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+
+        remote_channels = []
+
+        for member in members:
+            channel = member.decode("utf8")
+
+            if self._is_local(channel):
+                # Each consumer gets its own copy, as it would have from Redis.
+                if self._buffer(channel, dict(message)):
+                    delivery_counters["local"] += 1
+            else:
+                remote_channels.append(channel)
+
+        if remote_channels:
+            await self._send_to_channels(group, remote_channels, message)
+            delivery_counters["redis"] += len(remote_channels)
+
+    async def _send_to_channels(self, group, channel_names, message):
+        """Pushes the message to each of the channels through Redis, as channels_redis's group_send does."""
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for index, channel_keys in connection_to_channel_keys.items():
+            connection = self.connection(index)
+
+            # Discard expired messages.
+            async with connection.pipeline(transaction=False) as pipe:
+                for channel_key in channel_keys:
+                    pipe.zremrangebyscore(channel_key, min=0, max=int(time.time()) - int(self.expiry))
+
+                await pipe.execute()
+
+            args = [channel_keys_to_message[channel_key] for channel_key in channel_keys]
+            args += [channel_keys_to_capacity[channel_key] for channel_key in channel_keys]
+            args += [time.time(), self.expiry]
+
+            over_capacity = await get_script(connection, GROUP_SEND_SCRIPT)(keys=channel_keys, args=args)
+
+            if over_capacity > 0:
+                logger.info(f"{over_capacity} of {len(channel_names)} channels over capacity in group {group}")
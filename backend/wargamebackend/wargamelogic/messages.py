@@ -0,0 +1,113 @@
+# Helpers for building the messages sent over the WebSocket.
+# Every message is an object with "channel", "action" and "data" properties (see consumers.py).
+# By default messages are sent as JSON text frames, but a client that asks for the
+# MSGPACK_SUBPROTOCOL WebSocket subprotocol sends and receives them as MessagePack binary frames instead.
+
+import json
+import msgpack
+from functools import lru_cache
+from wargamelogic.outbound import message_key
+
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+def _message(channel, action, data, seq):
+    message = {
+        "channel": channel,
+        "action": action,
+        "data": data,
+    }
+
+    # Messages that were logged in the game's EventLog carry their sequence number.
+    if seq is not None:
+        message["seq"] = seq
+
+    return message
+
+def encode_message(channel, action, data, seq=None):
+    """Serialize a message into the text frame sent to the browser."""
+    return json.dumps(_message(channel, action, data, seq))
+
+def add_seq(text, seq):
+    """
+    Adds a sequence number to a text frame encoded without one,
+    giving the same text as encode_message would with it, without encoding the data again.
+    """
+    if seq is None:
+        return text
+
+    return f'{text[:-1]}, "seq": {seq}}}'
+
+def encode_message_bytes(channel, action, data, seq=None):
+    """Serialize a message into the binary frame sent to clients using MSGPACK_SUBPROTOCOL."""
+    return msgpack.packb(_message(channel, action, data, seq))
+
+@lru_cache(maxsize=128)
+def text_to_message_bytes(text):
+    """
+    Convert a text frame into the binary frame for clients using MSGPACK_SUBPROTOCOL.
+    Group messages only carry their text frame, so the consumers on a worker that use
+    MSGPACK_SUBPROTOCOL share one conversion of each message.
+    """
+    return msgpack.packb(json.loads(text))
+
+_JSON_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+def _check_json_types(value):
+    """
+    Raises ValueError if value holds anything a JSON message couldn't, like MessagePack bin or ext values,
+    since messages received as MessagePack are sent on to other clients as JSON.
+    """
+    values = [value]
+
+    while values:
+        value = values.pop()
+
+        if isinstance(value, dict):
+            if not all(isinstance(key, str) for key in value):
+                raise ValueError("object keys must be strings")
+
+            values.extend(value.values())
+
+        elif isinstance(value, list):
+            values.extend(value)
+
+        elif not isinstance(value, _JSON_SCALAR_TYPES):
+            raise ValueError(f"{type(value).__name__} values aren't allowed")
+
+def decode_message(text_data=None, bytes_data=None):
+    """
+    Deserialize a frame received from a client, whichever kind of frame it is.
+    Raises ValueError if the frame can't be decoded, or holds values JSON can't.
+    """
+    if bytes_data is not None:
+        try:
+            message = msgpack.unpackb(bytes_data, raw=False)
+
+        except msgpack.UnpackException as e:
+            raise ValueError(str(e)) from e
+
+        _check_json_types(message)
+        return message
+
+    return json.loads(text_data)
+
+async def group_send_message(channel_layer, group, channel, action, data, seq=None, text=None):
+    """
+    Sends a message to every consumer in a group.
+    The message is serialized here, as a text frame, and carried in the event, so each recipient's
+    handle_message can forward it without encoding it again (converting it for MSGPACK_SUBPROTOCOL if needed).
+    text is the message already encoded by encode_message without seq, if the caller has it.
+    """
+    if text is None:
+        text = encode_message(channel, action, data)
+
+    await channel_layer.group_send(
+        group,
+        {
+            "type": "handle.message",
+            "channel": channel,
+            "text": add_seq(text, seq),
+            "key": message_key(channel, action, data),
+        }
+    )
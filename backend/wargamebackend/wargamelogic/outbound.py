@@ -0,0 +1,133 @@
+# This file gives each WebSocket connection a bounded queue of messages waiting to be sent to its browser.
+# Every message to the browser goes through the queue, in order, and is sent by a separate task,
+# so a browser that is slow to read its messages only holds up its own queue
+# rather than the consumer's handling of new messages.
+# The queue only fills up when send() waits for the browser, which depends on the ASGI server:
+# Daphne writes every frame to its own buffer straight away, while e.g. Uvicorn waits when it's full.
+#
+# Messages can be given a key, meaning a later message with the same key carries everything it does,
+# like the units.move messages of a unit being dragged across the map (see message_key below).
+# Batches of coalesced messages (see coalescing.py) have no key, since each one holds updates to different things.
+# When a queue is full, what happens depends on settings.WEBSOCKET_SLOW_CONSUMER_POLICY:
+#   "drop_superseded": the oldest queued message that a newer one with the same key replaces is dropped,
+#                      so the browser doesn't miss anything. If there are none, the connection is closed.
+#   "close":           the connection is closed.
+# Connections are closed with SLOW_CONSUMER_CLOSE_CODE, which tells the client to reconnect
+# and replay what it missed (see event_log.py).
+# The consumer's own replies (errors, action results, replays) are never dropped;
+# they wait for room in the queue instead.
+
+import asyncio
+from collections import Counter, deque
+
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+DROP_SUPERSEDED = "drop_superseded"
+CLOSE = "close"
+
+# Totals for every connection on this worker.
+outbound_counters = Counter()
+
+def message_key(channel, action, data):
+    """
+    The key of a message that a later one with the same key replaces, or None if nothing replaces it.
+    Like coalescing.py, this treats messages with the same channel, action and data.id as updates to the same thing,
+    e.g. units.move messages, which each carry the whole UnitInstance.
+    Messages that aren't about one thing, like units.attack results or batches, have no id.
+    """
+    if not isinstance(data, dict):
+        return None
+
+    entity_id = data.get("id")
+    return f"{channel}.{action}.{entity_id}" if entity_id is not None else None
+
+class OutboundQueue:
+    def __init__(self, send, maxlen, policy):
+        """send is the consumer's send method."""
+        self.send = send
+        self.maxlen = maxlen
+        self.policy = policy
+        self.dropped = 0
+        self.overflowed = False
+
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """
+        Queue a frame, the keyword arguments for send (text_data or bytes_data), with the message's key.
+        Returns False if the queue is full and the connection should be closed instead,
+        after which nothing more is sent.
+        """
+        if self.overflowed:
+            return False
+
+        if len(self._frames) >= self.maxlen:
+            if self.policy != DROP_SUPERSEDED or not self._drop_superseded(key):
+                self.overflowed = True
+                self._frames.clear()
+                self._room.set()
+                outbound_counters["closed"] += 1
+                return False
+
+        self._append(frame, key)
+        return True
+
+    async def put_wait(self, frame):
+        """
+        Queue a frame that mustn't be dropped, waiting for room if the queue is full.
+        Returns False if the connection is being closed for falling behind.
+        """
+        while len(self._frames) >= self.maxlen and not self.overflowed:
+            self._room.clear()
+            await self._room.wait()
+
+        if self.overflowed:
+            return False
+
+        self._append(frame, None)
+        return True
+
+    def _append(self, frame, key):
+        self._frames.append((frame, key))
+        self._ready.set()
+
+    def _drop_superseded(self, key):
+        """Drops the oldest queued frame that a newer one (or the frame being queued, with key) replaces."""
+        newer_keys = {key} if key is not None else set()
+        superseded_index = None
+
+        # Walking back from the newest frame, the last frame seen whose key is already in newer_keys is the oldest superseded one.
+        for index, (_, frame_key) in zip(range(len(self._frames) - 1, -1, -1), reversed(self._frames)):
+            if frame_key is None:
+                continue
+
+            if frame_key in newer_keys:
+                superseded_index = index
+
+            newer_keys.add(frame_key)
+
+        if superseded_index is None:
+            return False
+
+        del self._frames[superseded_index]
+        self.dropped += 1
+        outbound_counters["dropped"] += 1
+        return True
+
+    async def run(self):
+        """Sends queued frames until cancelled."""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            while self._frames:
+                frame, _ = self._frames.popleft()
+                self._room.set()
+                await self.send(**frame)
@@ -0,0 +1,241 @@
+# This file keeps track of which users are connected to a game's WebSocket,
+# and which RoleInstance they joined as.
+# It's used by the GameConsumer, which runs on the event loop,
+# so every Redis call here is made with the asyncio Redis client.
+#
+# Every connection that has joined refreshes its entry with a heartbeat
+# every settings.WEBSOCKET_PRESENCE_HEARTBEAT_INTERVAL seconds. An entry that hasn't been
+# refreshed for settings.WEBSOCKET_PRESENCE_TTL seconds belongs to a connection whose worker
+# crashed or was killed before it could remove it, so it's treated as gone and swept away.
+# The time of each entry's last heartbeat is kept in a sorted set, so finding the stale
+# entries only reads the old end of the set rather than every entry in the game.
+#
+# The RoleInstances are stored separately for each team, so a player asking for
+# their team's users only reads that team's entries. Gamemasters see every team.
+# Keys, for each game:
+#   game_<join_code>_presence_seen                      user id -> time of last heartbeat
+#   game_<join_code>_presence_teams                     user id -> team name
+#   game_<join_code>_team_<team>_role_instances         user id -> RoleInstance JSON
+#   game_<join_code>_team_<team>_presence_seen          user id -> time of last heartbeat
+# The team keys are worked out inside the scripts below from the game's key prefix,
+# which they're passed as ARGV[1], so all of a game's keys must be on the same Redis,
+# which they are, since they're all on the game's shard (see sharding.py).
+
+import json
+import time
+from django.conf import settings
+from wargamelogic.redis_clients import get_async_game_redis_client, get_script
+
+
+# Shared by the scripts below.
+PRELUDE = """
+local prefix = ARGV[1]
+local seen_key = prefix .. 'presence_seen'
+local teams_key = prefix .. 'presence_teams'
+
+local function team_key(team)
+    return prefix .. 'team_' .. team .. '_role_instances'
+end
+
+local function team_seen_key(team)
+    return prefix .. 'team_' .. team .. '_presence_seen'
+end
+
+-- Removes the entries whose last heartbeat was at or before cutoff,
+-- returning the RoleInstances they had joined as.
+local function sweep(cutoff)
+    local stale = {}
+    local stale_ids = redis.call('ZRANGEBYSCORE', seen_key, '-inf', cutoff)
+
+    for _, user_id in ipairs(stale_ids) do
+        local team = redis.call('HGET', teams_key, user_id)
+
+        if team then
+            table.insert(stale, redis.call('HGET', team_key(team), user_id))
+            redis.call('HDEL', team_key(team), user_id)
+            redis.call('ZREM', team_seen_key(team), user_id)
+        end
+    end
+
+    if #stale_ids > 0 then
+        redis.call('HDEL', teams_key, unpack(stale_ids))
+        redis.call('ZREM', seen_key, unpack(stale_ids))
+    end
+
+    return stale
+end
+
+-- So a game nobody is connected to anymore doesn't leave its keys behind.
+local function expire(ttl, team)
+    redis.call('EXPIRE', seen_key, ttl)
+    redis.call('EXPIRE', teams_key, ttl)
+
+    if team then
+        redis.call('EXPIRE', team_key(team), ttl)
+        redis.call('EXPIRE', team_seen_key(team), ttl)
+    end
+end
+"""
+
+# ARGV: prefix, cutoff, ttl, now, user id, team name, RoleInstance JSON
+ADD_SCRIPT = PRELUDE + """
+local stale = sweep(ARGV[2])
+local added = redis.call('HSETNX', teams_key, ARGV[5], ARGV[6])
+
+if added == 1 then
+    redis.call('HSET', team_key(ARGV[6]), ARGV[5], ARGV[7])
+    redis.call('ZADD', seen_key, ARGV[4], ARGV[5])
+    redis.call('ZADD', team_seen_key(ARGV[6]), ARGV[4], ARGV[5])
+end
+
+expire(ARGV[3], ARGV[6])
+return {added, stale}
+"""
+
+# ARGV: prefix, cutoff, ttl, now, user id
+HEARTBEAT_SCRIPT = PRELUDE + """
+local team = redis.call('HGET', teams_key, ARGV[5])
+
+if team then
+    redis.call('ZADD', seen_key, 'XX', ARGV[4], ARGV[5])
+    redis.call('ZADD', team_seen_key(team), 'XX', ARGV[4], ARGV[5])
+end
+
+local stale = sweep(ARGV[2])
+expire(ARGV[3], team)
+return stale
+"""
+
+# ARGV: prefix, user id
+REMOVE_SCRIPT = PRELUDE + """
+local team = redis.call('HGET', teams_key, ARGV[2])
+
+if not team then
+    return false
+end
+
+local role_instance = redis.call('HGET', team_key(team), ARGV[2])
+redis.call('HDEL', teams_key, ARGV[2])
+redis.call('ZREM', seen_key, ARGV[2])
+redis.call('HDEL', team_key(team), ARGV[2])
+redis.call('ZREM', team_seen_key(team), ARGV[2])
+return role_instance
+"""
+
+# ARGV: prefix, user id
+GET_SCRIPT = PRELUDE + """
+local team = redis.call('HGET', teams_key, ARGV[2])
+
+if not team then
+    return false
+end
+
+return redis.call('HGET', team_key(team), ARGV[2])
+"""
+
+# ARGV: prefix, cutoff, team name
+TEAM_SCRIPT = PRELUDE + """
+local user_ids = redis.call('ZRANGEBYSCORE', team_seen_key(ARGV[3]), '(' .. ARGV[2], '+inf')
+
+if #user_ids == 0 then
+    return {}
+end
+
+return redis.call('HMGET', team_key(ARGV[3]), unpack(user_ids))
+"""
+
+# ARGV: prefix, cutoff
+ALL_SCRIPT = PRELUDE + """
+local role_instances = {}
+local user_ids = redis.call('ZRANGEBYSCORE', seen_key, '(' .. ARGV[2], '+inf')
+
+if #user_ids == 0 then
+    return role_instances
+end
+
+local teams = redis.call('HMGET', teams_key, unpack(user_ids))
+
+for i, user_id in ipairs(user_ids) do
+    if teams[i] then
+        table.insert(role_instances, redis.call('HGET', team_key(teams[i]), user_id))
+    end
+end
+
+return role_instances
+"""
+
+def _decode_role_instances(role_instance_jsons):
+    return [
+        json.loads(role_instance_json)
+        for role_instance_json in role_instance_jsons
+        if role_instance_json
+    ]
+
+class PresenceStore:
+    """
+    The RoleInstances of the users connected to a game, partitioned by team,
+    along with the time of each user's last heartbeat.
+    """
+    def __init__(self, join_code):
+        self.join_code = join_code
+        self.prefix = f"game_{join_code}_"
+
+    def _cutoff(self, now):
+        return now - settings.WEBSOCKET_PRESENCE_TTL
+
+    async def _run(self, script, *args):
+        redis_client = get_async_game_redis_client(self.join_code)
+        return await get_script(redis_client, script)(args=[self.prefix, *args])
+
+    async def add(self, user_id, role_instance):
+        """
+        Record that the user joined as role_instance, sweeping away stale entries first.
+        Returns whether the user was added, which is False, without overwriting anything,
+        if the user had already joined, along with the RoleInstances of the stale entries.
+        """
+        now = time.time()
+        team_name = role_instance["team_instance"]["team"]["name"]
+
+        added, stale = await self._run(
+            ADD_SCRIPT,
+            self._cutoff(now), settings.WEBSOCKET_PRESENCE_TTL, now,
+            user_id, team_name, json.dumps(role_instance)
+        )
+
+        return bool(added), _decode_role_instances(stale)
+
+    async def heartbeat(self, user_id):
+        """
+        Record that the user's connection is still alive, sweeping away stale entries.
+        Returns the RoleInstances of the stale entries.
+        """
+        now = time.time()
+
+        stale = await self._run(
+            HEARTBEAT_SCRIPT,
+            self._cutoff(now), settings.WEBSOCKET_PRESENCE_TTL, now, user_id
+        )
+
+        return _decode_role_instances(stale)
+
+    async def remove(self, user_id):
+        """
+        Forget the user, returning the RoleInstance they had joined as,
+        or None if they hadn't joined.
+        """
+        role_instance_json = await self._run(REMOVE_SCRIPT, user_id)
+        return json.loads(role_instance_json) if role_instance_json else None
+
+    async def get(self, user_id):
+        role_instance_json = await self._run(GET_SCRIPT, user_id)
+        return json.loads(role_instance_json) if role_instance_json else None
+
+    async def team(self, team_name):
+        """Returns the RoleInstances of the users connected to the game on a team, leaving out stale entries."""
+        role_instance_jsons = await self._run(TEAM_SCRIPT, self._cutoff(time.time()), team_name)
+        return _decode_role_instances(role_instance_jsons)
+
+    async def all(self):
+        """Returns the RoleInstances of every user connected to the game, leaving out stale entries."""
+        role_instance_jsons = await self._run(ALL_SCRIPT, self._cutoff(time.time()))
+        return _decode_role_instances(role_instance_jsons)
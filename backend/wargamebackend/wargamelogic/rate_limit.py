@@ -0,0 +1,105 @@
+# This file limits how fast one WebSocket connection can send messages,
+# so a buggy or malicious browser tab sending messages in a loop can't flood its game's channel layer
+# or use up the worker's time that every other connection on it shares.
+# Limits are token buckets, given as (messages per second, burst): a connection can send up to burst
+# messages at once, after which it can send one more every 1 / (messages per second) seconds.
+# Every connection has one bucket for all of its messages (settings.WEBSOCKET_RATE_LIMIT),
+# and one for each (channel, action) it sends (settings.WEBSOCKET_ACTION_RATE_LIMIT,
+# or the limit for that channel and action in settings.WEBSOCKET_ACTION_RATE_LIMITS).
+# A message has to get past both, and is checked before anything is done with it.
+# A refused message is dropped, and the sender is sent an errors.throttled message,
+# only once until they're allowed to send a message again, so the errors don't become a flood of their own.
+
+import time
+from collections import Counter
+
+
+# Messages with a (channel, action) beyond this many different ones on a connection share one bucket,
+# so a connection can't use up memory by making them up.
+MAX_ACTION_BUCKETS = 64
+
+# Totals for every connection on this worker.
+rate_limit_counters = Counter()
+
+class TokenBucket:
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def take(self, now):
+        """Takes a token if there is one. Returns 0 if there was, or how many seconds until there will be."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """The token buckets of one connection. A limit of None means unlimited."""
+    def __init__(self, limit, action_limit, action_limits=None):
+        self.bucket = TokenBucket(*limit) if limit else None
+        self.action_limit = action_limit
+        self.action_limits = action_limits or {}
+        self.action_buckets = {}
+        self.throttled = False
+
+    def _action_bucket(self, channel, action, now):
+        key = f"{channel}.{action}"
+        bucket = self.action_buckets.get(key)
+
+        if bucket is None:
+            limit = self.action_limits.get(key, self.action_limit)
+
+            if not limit:
+                return None
+
+            if len(self.action_buckets) >= MAX_ACTION_BUCKETS:
+                key = None
+                bucket = self.action_buckets.get(key)
+
+            if bucket is None:
+                bucket = self.action_buckets[key] = TokenBucket(*limit, now=now)
+
+        return bucket
+
+    def check(self, channel, action):
+        """
+        Returns 0 if the message can be sent, or how many seconds until it could have been if it can't.
+        A refused message doesn't use up a token from either bucket.
+        """
+        now = time.monotonic()
+        retry_after = self.bucket.take(now) if self.bucket else 0
+
+        if retry_after:
+            rate_limit_counters["throttled"] += 1
+            rate_limit_counters["throttled_connection"] += 1
+            return retry_after
+
+        action_bucket = self._action_bucket(channel, action, now)
+        retry_after = action_bucket.take(now) if action_bucket else 0
+
+        if retry_after:
+            # Give back the connection's token, since the message isn't being sent.
+            if self.bucket:
+                self.bucket.tokens += 1
+
+            rate_limit_counters["throttled"] += 1
+            rate_limit_counters["throttled_action"] += 1
+            return retry_after
+
+        rate_limit_counters["allowed"] += 1
+        return 0
+
+    def should_notify(self, retry_after):
+        """
+        Whether the sender should be told their message was refused,
+        which is only the first time since they last sent a message that wasn't.
+        """
+        notify = bool(retry_after) and not self.throttled
+        self.throttled = bool(retry_after)
+        return notify
@@ -0,0 +1,87 @@
+# Helpers for getting a Redis client.
+# Synchronous code (views, signal receivers, startup) uses the client
+# that django-redis already pools for the cache,
+# while code running on the event loop (the WebSocket consumer) must use
+# the asyncio client so that a Redis round trip never blocks the other sockets on the worker.
+# Keys belonging to a game live on the game's shard (see sharding.py),
+# which is the cache's Redis unless settings.GAME_REDIS_SHARDS says otherwise.
+# Lua scripts are run through get_script, so Redis is only sent a script's text once.
+
+import weakref
+import asyncio
+import threading
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from redis import asyncio as aioredis
+from wargamelogic.sharding import get_game_shard_url
+
+
+def _pool_kwargs():
+    return settings.CACHES["default"].get("OPTIONS", {}).get("CONNECTION_POOL_KWARGS", {})
+
+def get_redis_client():
+    """Get the synchronous Redis client."""
+    return cache.client.get_client(write=True)
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+def _get_redis_client_for_url(url):
+    if url == settings.REDIS_URL:
+        return get_redis_client()
+
+    with _redis_clients_lock:
+        client = _redis_clients.get(url)
+
+        if client is None:
+            client = _redis_clients[url] = redis.Redis.from_url(url, **_pool_kwargs())
+
+        return client
+
+def get_game_redis_client(join_code):
+    """Get the synchronous Redis client for the shard holding the game's keys."""
+    return _get_redis_client_for_url(get_game_shard_url(join_code))
+
+def get_game_redis_clients():
+    """Get a synchronous Redis client for every shard that holds games' keys."""
+    return [_get_redis_client_for_url(url) for url in settings.GAME_REDIS_SHARDS]
+
+# asyncio connections belong to the event loop that opened them,
+# so each running loop gets its own pooled client for each Redis instance.
+_async_redis_clients = weakref.WeakKeyDictionary()
+
+def _get_async_redis_client_for_url(url):
+    loop = asyncio.get_running_loop()
+    clients = _async_redis_clients.setdefault(loop, {})
+    client = clients.get(url)
+
+    if client is None:
+        client = clients[url] = aioredis.Redis.from_url(url, decode_responses=True, **_pool_kwargs())
+
+    return client
+
+def get_async_redis_client():
+    """Get the pooled asyncio Redis client for the running event loop."""
+    return _get_async_redis_client_for_url(settings.REDIS_URL)
+
+def get_async_game_redis_client(join_code):
+    """Get the pooled asyncio Redis client for the shard holding the game's keys."""
+    return _get_async_redis_client_for_url(get_game_shard_url(join_code))
+
+# Each running loop's redis-py Scripts, by client and then by the script's text.
+_async_scripts = weakref.WeakKeyDictionary()
+
+def get_script(client, script):
+    """
+    Get the client's redis-py Script for a Lua script, which runs it by its SHA1 with EVALSHA,
+    only sending Redis the script's text the first time (or after Redis restarts).
+    """
+    loop = asyncio.get_running_loop()
+    scripts = _async_scripts.setdefault(loop, {}).setdefault(client, {})
+    registered_script = scripts.get(script)
+
+    if registered_script is None:
+        registered_script = scripts[script] = client.register_script(script)
+
+    return registered_script
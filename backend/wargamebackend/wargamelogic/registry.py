@@ -0,0 +1,85 @@
+# This file lets the GameConsumer declare which of its methods handles each (channel, action)
+# message, and what the message's data must look like, e.g.
+#
+#     @registry.handler("users", "join", {
+#         "user.username": str,
+#         "role.name": str,
+#     })
+#     async def handle_users_join(self, data):
+#         ...
+#
+# Each schema maps the dotted path of a property in data to the type (or tuple of types) it must have.
+# Schemas are compiled into validators once, when the consumer class is defined,
+# so checking a message only walks the paths it lists.
+# A message that doesn't match its schema, or that its handler refuses by raising MessageError,
+# is answered with an errors.invalid message to just the sender instead of closing their connection.
+
+class MessageError(Exception):
+    """Raised by a handler to refuse a message. The sender is sent the error's message."""
+
+def _type_names(types):
+    names = ["integer" if t is int else "number" if t is float else "string" if t is str else t.__name__ for t in types]
+    return " or ".join(names)
+
+def compile_schema(schema):
+    """
+    Turns a schema into a function that takes a message's data and returns None if it matches,
+    or a description of the first thing that doesn't.
+    """
+    fields = []
+
+    for path, types in (schema or {}).items():
+        types = types if isinstance(types, tuple) else (types,)
+
+        # int and float already mean numbers, and True and False are ints in Python.
+        if float in types and int not in types:
+            types += (int,)
+
+        fields.append((
+            tuple(path.split(".")),
+            types,
+            bool not in types,
+            f"missing '{path}'",
+            f"'{path}' must be {_type_names(types)}",
+        ))
+
+    def validate(data):
+        if not isinstance(data, dict):
+            return "'data' must be an object"
+
+        for parts, types, reject_bools, missing, wrong_type in fields:
+            value = data
+
+            for part in parts:
+                if not isinstance(value, dict) or part not in value:
+                    return missing
+
+                value = value[part]
+
+            if not isinstance(value, types) or (reject_bools and isinstance(value, bool)):
+                return wrong_type
+
+        return None
+
+    return validate
+
+class MessageHandler:
+    def __init__(self, method, validate):
+        self.method = method
+        self.validate = validate
+
+class MessageRegistry:
+    """Maps (channel, action) pairs to the consumer methods that handle them."""
+    def __init__(self):
+        self.handlers = {}
+
+    def handler(self, channel, action, schema=None):
+        """Decorator registering a consumer method as the handler for a channel and action."""
+        def decorator(method):
+            self.handlers[(channel, action)] = MessageHandler(method, compile_schema(schema))
+            return method
+
+        return decorator
+
+    def get(self, channel, action):
+        return self.handlers.get((channel, action))
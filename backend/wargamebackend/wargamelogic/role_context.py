@@ -0,0 +1,59 @@
+# This file loads who a WebSocket user is in their game: the RoleInstance they have in it,
+# which is looked up once per connection when they join (see consumers.py) rather than
+# taken from what their browser says in each message.
+# The consumer routes every message from the RoleContext, so a browser can't send messages
+# to groups it isn't in by claiming to be on another team or to have another role,
+# and it doesn't need to send its RoleInstance along with every message.
+
+from channels.db import database_sync_to_async
+from wargamelogic.models.dynamic import RoleInstance
+from wargamelogic.serializers import RoleInstanceSerializer
+from wargamelogic.topology import GAMEMASTER_TEAM_NAME
+
+
+class RoleContext:
+    """The parts of a user's RoleInstance that messages are routed by."""
+    __slots__ = (
+        "role_instance_id", "team_name", "role_name", "branch_name",
+        "is_chief_of_staff", "is_commander", "is_vice_commander", "is_logistics",
+        "role_instance",
+    )
+
+    def __init__(self, role_instance):
+        role = role_instance.role
+
+        self.role_instance_id = role_instance.id
+        self.team_name = role_instance.team_instance.team.name
+        self.role_name = role.name
+        self.branch_name = role.branch.name if role.branch else None
+        self.is_chief_of_staff = role.is_chief_of_staff
+        self.is_commander = role.is_commander
+        self.is_vice_commander = role.is_vice_commander
+        self.is_logistics = role.is_logistics
+
+        # The RoleInstance as the REST API returns it, which is how it's sent in messages.
+        self.role_instance = RoleInstanceSerializer(role_instance).data
+
+    @property
+    def key(self):
+        """The (team name, role name) pair used by topology.py."""
+        return self.team_name, self.role_name
+
+    @property
+    def is_gamemaster(self):
+        return self.team_name == GAMEMASTER_TEAM_NAME
+
+def load_role_context(user, join_code):
+    """
+    The RoleContext of the user's RoleInstance in the game, or None if they don't have one.
+    If they somehow have several, it's always the one that was created first.
+    """
+    role_instance = RoleInstance.objects.select_related(
+        "user", "team_instance__game_instance", "team_instance__team", "role__branch"
+    ).filter(
+        user=user, team_instance__game_instance__join_code=join_code
+    ).order_by("id").first()
+
+    return RoleContext(role_instance) if role_instance else None
+
+aload_role_context = database_sync_to_async(load_role_context)
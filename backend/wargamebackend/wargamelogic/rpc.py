@@ -0,0 +1,49 @@
+# This file lets the GameConsumer run the REST API's PATCH endpoints for game actions
+# (moving units, attacking and transferring supply points, see views/patch.py)
+# over a user's already-open WebSocket, instead of the browser sending a separate HTTP request.
+# The endpoint's view is called directly with a request built here, so the action goes through
+# exactly the same authorization, validation and saving as it would over HTTP.
+# The endpoints only check that the user may act on the units, not that the units are in the game
+# whose WebSocket the action came in on, so the consumer checks that first (see units_in_game).
+
+import io
+import json
+from django.http import HttpRequest
+from rest_framework.renderers import JSONRenderer
+from channels.db import database_sync_to_async
+from wargamelogic.models.dynamic import UnitInstance
+
+
+def call_view(view, user, body, **kwargs):
+    """
+    Calls a REST API view with a PATCH request from the user, with body as its JSON body
+    and kwargs as the arguments that would have been captured from its URL.
+    Returns the response's status code and data, as plain JSON-compatible values.
+    """
+    content = json.dumps(body).encode()
+
+    request = HttpRequest()
+    request.method = "PATCH"
+    request.META["CONTENT_TYPE"] = "application/json"
+    request.META["CONTENT_LENGTH"] = str(len(content))
+    request._stream = io.BytesIO(content)
+
+    # The user was already authenticated when they connected to the WebSocket,
+    # so DRF is told who they are the same way its test client does,
+    # rather than through the access token cookie.
+    request._force_auth_user = user
+
+    response = view(request, **kwargs)
+    return response.status_code, json.loads(JSONRenderer().render(response.data) or "null")
+
+acall_view = database_sync_to_async(call_view)
+
+def units_in_game(join_code, *unit_instance_ids):
+    """Whether every one of the UnitInstances exists and is in the game."""
+    unit_instance_ids = set(unit_instance_ids)
+
+    return UnitInstance.objects.filter(
+        pk__in=unit_instance_ids, team_instance__game_instance__join_code=join_code
+    ).count() == len(unit_instance_ids)
+
+aunits_in_game = database_sync_to_async(units_in_game)
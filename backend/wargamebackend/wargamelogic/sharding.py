@@ -0,0 +1,63 @@
+# This file spreads games over the Redis instances listed in settings.GAME_REDIS_SHARDS,
+# so that on days with many games being played at once, one busy game's WebSocket traffic
+# only competes with the games on the same instance.
+# Everything belonging to one game is kept on the same instance: its channel layer groups
+# (see layers.py), its presence entries (see presence.py) and its event log (see event_log.py).
+# Games are assigned to instances with consistent hashing on their join code,
+# so adding an instance only moves the games that the new instance takes over.
+
+import bisect
+import hashlib
+from django.conf import settings
+
+
+class HashRing:
+    """Assigns keys to nodes with consistent hashing."""
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+
+        # Each node is placed on the ring many times, so keys are spread evenly.
+        ring = sorted(
+            (self._hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._indexes = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def index(self, key):
+        """The index, in nodes, of the node that key belongs to."""
+        position = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._indexes[position]
+
+    def node(self, key):
+        return self.nodes[self.index(key)]
+
+def join_code_from_group(group):
+    """
+    The join code of the game a group or Redis key belongs to, e.g. "ABC" for "game_ABC_team_USA",
+    or None if it doesn't belong to a game. Join codes can't contain underscores (see routing.py).
+    """
+    if not group.startswith("game_"):
+        return None
+
+    return group[len("game_"):].split("_", 1)[0]
+
+_rings = {}
+
+def get_game_shard_ring():
+    shards = tuple(settings.GAME_REDIS_SHARDS)
+    ring = _rings.get(shards)
+
+    if ring is None:
+        ring = _rings[shards] = HashRing(shards)
+
+    return ring
+
+def get_game_shard_url(join_code):
+    """The URL of the Redis instance holding the game's keys."""
+    return get_game_shard_ring().node(join_code)
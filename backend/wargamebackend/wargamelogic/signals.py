@@ -0,0 +1,47 @@
+# Signal receivers that keep data derived from the database up to date
+# when the tables it's derived from change.
+# They are connected in apps.py.
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from auth.role_cache import invalidate_role_memberships, invalidate_all_role_memberships
+from auth.user_cache import invalidate_cached_user
+from wargamelogic.models.static import (
+    Team, Branch, Role, Unit, UnitBranch, Attack, Ability, Landmark
+)
+from wargamelogic.models.dynamic import (
+    GameInstance, TeamInstance, RoleInstance
+)
+from wargamelogic.static_cache import bump_static_catalog_version
+
+
+@receiver([post_save, post_delete], sender=Team)
+@receiver([post_save, post_delete], sender=Branch)
+@receiver([post_save, post_delete], sender=Role)
+@receiver([post_save, post_delete], sender=Unit)
+@receiver([post_save, post_delete], sender=UnitBranch)
+@receiver([post_save, post_delete], sender=Attack)
+@receiver([post_save, post_delete], sender=Ability)
+@receiver([post_save, post_delete], sender=Landmark)
+def static_catalog_changed(sender, **kwargs):
+    bump_static_catalog_version()
+
+    # Users' cached RoleInstances hold their roles, branches and teams.
+    if sender in (Team, Branch, Role):
+        invalidate_all_role_memberships()
+
+@receiver([post_save, post_delete], sender=GameInstance)
+@receiver([post_save, post_delete], sender=TeamInstance)
+def game_instance_changed(sender, **kwargs):
+    invalidate_all_role_memberships()
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.id)
+    invalidate_role_memberships(instance.id)
+
+@receiver([post_save, post_delete], sender=RoleInstance)
+def role_instance_changed(sender, instance, **kwargs):
+    invalidate_role_memberships(instance.user_id)
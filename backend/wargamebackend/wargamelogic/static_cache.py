@@ -0,0 +1,106 @@
+# This file caches the static tables (teams, branches, roles, units, attacks, abilities and landmarks),
+# which only change when an admin edits them.
+# Each worker keeps its own copy in memory, tagged with the version number stored in Redis
+# under STATIC_CATALOG_VERSION_KEY. Saving or deleting a row in one of these tables
+# bumps the version (see signals.py), and every worker rebuilds its copy
+# the next time it notices its version is out of date.
+
+import threading
+from django.db import transaction
+from django.http import Http404
+from channels.db import database_sync_to_async
+from wargamelogic.models.static import (
+    Team, Branch, Role, Unit, Attack, Ability, Landmark
+)
+from wargamelogic.redis_clients import get_redis_client, get_async_redis_client
+from wargamelogic.topology import RoleTopology
+
+
+STATIC_CATALOG_VERSION_KEY = "static_catalog_version"
+
+class StaticCatalog:
+    """
+    An in-memory copy of the static tables, with lookups by name.
+    The model instances are shared by every request on the worker, so they must not be modified.
+    """
+    def __init__(self, version):
+        self.version = version
+
+        self.teams = list(Team.objects.all())
+        self.branches = list(Branch.objects.all())
+        self.roles = list(Role.objects.select_related("branch"))
+        self.units = list(Unit.objects.prefetch_related("branches"))
+        self.attacks = list(Attack.objects.select_related("unit").prefetch_related("unit__branches"))
+        self.abilities = list(Ability.objects.select_related("unit").prefetch_related("unit__branches"))
+        self.landmarks = list(Landmark.objects.all())
+
+        self.teams_by_name = {team.name: team for team in self.teams}
+        self.roles_by_name = {role.name: role for role in self.roles}
+        self.units_by_name = {unit.name: unit for unit in self.units}
+        self.attacks_by_unit_and_name = {(attack.unit.name, attack.name): attack for attack in self.attacks}
+        self.abilities_by_unit_and_name = {(ability.unit.name, ability.name): ability for ability in self.abilities}
+        self.landmarks_by_name = {landmark.name: landmark for landmark in self.landmarks}
+
+        self.role_topology = RoleTopology(self.teams, self.roles)
+
+def get_cached_or_404(lookup, key):
+    """Like get_object_or_404, but for one of a StaticCatalog's lookups."""
+    try:
+        return lookup[key]
+
+    except KeyError:
+        raise Http404(f"No match found for {key}.")
+
+# ------------------------ #
+# Versioning               #
+# ------------------------ #
+
+_static_catalog = None
+_static_catalog_lock = threading.Lock()
+
+def _decode_version(version):
+    return int(version) if version is not None else 0
+
+def _build_static_catalog(version):
+    global _static_catalog
+
+    with _static_catalog_lock:
+        if _static_catalog is None or _static_catalog.version != version:
+            _static_catalog = StaticCatalog(version)
+
+        return _static_catalog
+
+def get_static_catalog():
+    """Get this worker's StaticCatalog, rebuilding it if the tables have changed."""
+    version = _decode_version(get_redis_client().get(STATIC_CATALOG_VERSION_KEY))
+    static_catalog = _static_catalog
+
+    if static_catalog is None or static_catalog.version != version:
+        static_catalog = _build_static_catalog(version)
+
+    return static_catalog
+
+async def aget_static_catalog():
+    """Same as get_static_catalog, but only leaves the event loop if the database must be queried."""
+    version = _decode_version(await get_async_redis_client().get(STATIC_CATALOG_VERSION_KEY))
+    static_catalog = _static_catalog
+
+    if static_catalog is None or static_catalog.version != version:
+        static_catalog = await database_sync_to_async(_build_static_catalog)(version)
+
+    return static_catalog
+
+def get_role_topology():
+    return get_static_catalog().role_topology
+
+def bump_static_catalog_version():
+    """
+    Makes every worker rebuild its StaticCatalog.
+    The version is bumped right away, and again once the current transaction commits,
+    so that a worker that rebuilt its copy before the commit doesn't keep the old rows.
+    """
+    def bump():
+        get_redis_client().incr(STATIC_CATALOG_VERSION_KEY)
+
+    bump()
+    transaction.on_commit(bump)
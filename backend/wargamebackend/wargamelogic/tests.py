@@ -1,15 +1,79 @@
+import copy
 import json
+import atexit
+import asyncio
+import logging
+import logging.config
+import threading
+from types import SimpleNamespace
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
 from rest_framework import status
 from rest_framework.test import APIClient
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, RequestFactory, override_settings
 from django.contrib.auth.models import User
 from urllib.parse import quote
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from auth.authentication import CookieJWTAuthentication
+from auth.middleware import CookieJWTAuthenticationWebSocketMiddleware
+from auth.authorization import (
+    CompiledCriteria, role_instance_matches
+)
+from auth.role_cache import (
+    get_role_memberships, _get_local_role_memberships
+)
+from auth.user_cache import (
+    get_user_cache, get_cached_user
+)
 from wargamelogic.models.static import (
     Team, Branch, Role, Unit, Attack, UnitBranch, Landmark, Tile
 )
 from wargamelogic.models.dynamic import (
     GameInstance, TeamInstance, RoleInstance, UnitInstance, LandmarkInstance, LandmarkInstanceTile
 )
+from wargamelogic.serializers import (
+    RoleInstanceSerializer
+)
+from wargamelogic.consumers import (
+    GameConsumer
+)
+from wargamelogic.messages import (
+    add_seq, encode_message, encode_message_bytes, text_to_message_bytes
+)
+from wargamelogic.presence import (
+    PresenceStore
+)
+from wargamelogic.static_cache import (
+    get_role_topology, get_static_catalog
+)
+from wargamelogic.layers import (
+    GameChannelLayer, delivery_counters
+)
+from wargamelogic.redis_clients import (
+    get_game_redis_client, get_async_game_redis_client, get_script
+)
+from wargamelogic.sharding import (
+    HashRing, join_code_from_group
+)
+from wargamelogic.coalescing import (
+    coalesce_message
+)
+from wargamelogic.outbound import (
+    OutboundQueue, message_key
+)
+from wargamelogic.registry import (
+    compile_schema
+)
+from wargamelogic.rate_limit import (
+    TokenBucket, RateLimiter
+)
+from wargamebackend.log import (
+    StructuredFormatter, BackgroundQueueHandler
+)
 
 
 class GetEndpointTests(TestCase):
@@ -685,4 +749,1071 @@ class TeamInstanceViewSetTests(BaseInstanceViewSetTestCase):
         self.auth(self.gm_user)
         url = f"/api/team-instances/{self.ti_red.id}/"
         resp = self.client.delete(url)
-        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+# ---------------------------- #
+# RoleTopology tests           #
+# ---------------------------- #
+class RoleTopologyTests(TestCase):
+    def setUp(self):
+        self.navy_branch = Branch.objects.create(name="Navy")
+
+        Team.objects.create(name="Gamemasters")
+        Team.objects.create(name="USA")
+
+        Role.objects.create(name="Gamemaster")
+        Role.objects.create(name="Combatant Commander")
+        Role.objects.create(name="Navy Chief", branch=self.navy_branch, is_chief_of_staff=True)
+        self.logistics_role = Role.objects.create(name="Navy Logistics", branch=self.navy_branch, is_commander=True, is_logistics=True)
+
+    def test_channel_and_transfer_groups(self):
+        role_topology = get_role_topology()
+
+        self.assertEqual(
+            role_topology.channel_groups("J1", "USA", "Navy Chief"),
+            [
+                "game_J1_channel_GamemastersGamemaster_USANavyChief",
+                "game_J1_channel_USACombatantCommander_USANavyChief",
+                "game_J1_channel_USANavyChief_USANavyChief",
+                "game_J1_channel_USANavyChief_USANavyLogistics",
+            ]
+        )
+        self.assertEqual(
+            role_topology.transfer_groups("J1", "USA", "Navy Chief"),
+            [
+                "game_J1_transfer_USANavyChief_USANavyLogistics",
+                "game_J1_transfer_GamemastersGamemaster_USANavyChief",
+                "game_J1_transfer_USACombatantCommander_USANavyChief",
+            ]
+        )
+        self.assertTrue(role_topology.can_transfer(("USA", "Navy Chief"), ("USA", "Navy Logistics")))
+        self.assertFalse(role_topology.can_transfer(("USA", "Navy Logistics"), ("USA", "Navy Chief")))
+        self.assertTrue(role_topology.can_communicate(("Gamemasters", "Gamemaster"), ("USA", "Navy Logistics")))
+
+    def test_rebuilt_when_roles_change(self):
+        self.assertTrue(get_role_topology().can_transfer(("USA", "Navy Chief"), ("USA", "Navy Logistics")))
+
+        self.logistics_role.is_logistics = False
+        self.logistics_role.is_operations = True
+        self.logistics_role.save()
+
+        self.assertFalse(get_role_topology().can_transfer(("USA", "Navy Chief"), ("USA", "Navy Logistics")))
+
+# ---------------------------- #
+# StaticCatalog tests          #
+# ---------------------------- #
+class StaticCatalogTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="catalog_user", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.team = Team.objects.create(name="USA")
+
+    def test_catalog_is_reused_until_a_static_table_changes(self):
+        static_catalog = get_static_catalog()
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_static_catalog(), static_catalog)
+
+        Team.objects.create(name="Russia")
+        self.assertIsNot(get_static_catalog(), static_catalog)
+        self.assertIn("Russia", get_static_catalog().teams_by_name)
+
+    def test_get_team_by_name_uses_catalog(self):
+        get_static_catalog()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(f"/api/teams/{self.team.name}/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["name"], self.team.name)
+
+        response = self.client.get("/api/teams/Nobody/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+# ---------------------------- #
+# GameChannelLayer tests       #
+# ---------------------------- #
+class GameChannelLayerTests(TestCase):
+    def test_group_add_and_discard_many(self):
+        async def run():
+            channel_layer = GameChannelLayer(hosts=[settings.REDIS_URL], prefix="test_asgi")
+            channel = await channel_layer.new_channel()
+            groups = [f"test_group_{i}" for i in range(20)]
+
+            await channel_layer.group_add_many(groups, channel)
+            await channel_layer.group_send("test_group_7", {"type": "test.message"})
+            self.assertEqual((await channel_layer.receive(channel))["type"], "test.message")
+
+            await channel_layer.group_discard_many(groups, channel)
+            connection = channel_layer.connection(0)
+            for group in groups:
+                self.assertEqual(await connection.zcard(channel_layer._group_key(group)), 0)
+
+            await channel_layer.flush()
+
+        async_to_sync(run)()
+
+    def test_groups_of_a_game_share_a_shard(self):
+        hosts = ["redis://127.0.0.1:6379/1", "redis://127.0.0.1:6379/2", "redis://127.0.0.1:6379/3"]
+        channel_layer = GameChannelLayer(hosts=hosts)
+
+        for join_code in ["ABC", "XYZ-1", "game.7"]:
+            shards = {
+                channel_layer.consistent_hash(group)
+                for group in [f"game_{join_code}", f"game_{join_code}_user_1", f"game_{join_code}_team_USA", f"game_{join_code}_channel_A_B"]
+            }
+            self.assertEqual(shards, {HashRing(hosts).index(join_code)})
+
+    def test_local_delivery_skips_redis_for_channels_in_this_process(self):
+        async def run():
+            channel_layer = GameChannelLayer(hosts=[settings.REDIS_URL], prefix="test_asgi", local_delivery=True)
+            # Stands in for another process, with its own client prefix.
+            other_channel_layer = GameChannelLayer(hosts=[settings.REDIS_URL], prefix="test_asgi")
+
+            local_channel = await channel_layer.new_channel()
+            remote_channel = await other_channel_layer.new_channel()
+            await channel_layer.group_add_many(["test_group"], local_channel)
+            await channel_layer.group_add_many(["test_group"], remote_channel)
+
+            receiving = asyncio.create_task(channel_layer.receive(local_channel))
+            await asyncio.sleep(0.1)
+            local_before = delivery_counters["local"]
+            redis_before = delivery_counters["redis"]
+
+            await channel_layer.group_send("test_group", {"type": "test.message"})
+            self.assertEqual((await asyncio.wait_for(receiving, 1))["type"], "test.message")
+            self.assertEqual((await other_channel_layer.receive(remote_channel))["type"], "test.message")
+            self.assertEqual((delivery_counters["local"] - local_before, delivery_counters["redis"] - redis_before), (1, 1))
+
+            await channel_layer.flush()
+
+        async_to_sync(run)()
+
+    def test_channels_no_longer_receiving_get_no_buffer(self):
+        async def run():
+            channel_layer = GameChannelLayer(hosts=[settings.REDIS_URL], prefix="test_asgi", local_delivery=True, capacity=2)
+            gone_channel = await channel_layer.new_channel()
+            full_channel = await channel_layer.new_channel()
+            await channel_layer.group_add_many(["test_group"], gone_channel)
+            await channel_layer.group_add_many(["test_group"], full_channel)
+
+            # A consumer that went away without leaving its groups.
+            receiving = asyncio.create_task(channel_layer.receive(gone_channel))
+            await asyncio.sleep(0.1)
+            receiving.cancel()
+            await asyncio.gather(receiving, return_exceptions=True)
+
+            # A consumer that's receiving, but slower than messages arrive.
+            receiving = asyncio.create_task(channel_layer.receive(full_channel))
+            await asyncio.sleep(0.1)
+            orphaned_before = delivery_counters["orphaned"]
+            over_capacity_before = delivery_counters["over_capacity"]
+
+            for _ in range(4):
+                await channel_layer.group_send("test_group", {"type": "test.message"})
+
+            self.assertNotIn(gone_channel, channel_layer.receive_buffer)
+            self.assertEqual(delivery_counters["orphaned"] - orphaned_before, 4)
+            # The first message was handed straight to the waiting receive().
+            self.assertEqual(channel_layer.receive_buffer[full_channel].qsize(), 2)
+            self.assertEqual(delivery_counters["over_capacity"] - over_capacity_before, 1)
+
+            reader = channel_layer._reader
+            receiving.cancel()
+            await channel_layer.flush()
+            await asyncio.gather(reader, return_exceptions=True)
+            self.assertTrue(reader.done())
+
+        async_to_sync(run)()
+
+# ---------------------------- #
+# Sharding tests               #
+# ---------------------------- #
+class HashRingTests(TestCase):
+    def test_join_code_from_group(self):
+        self.assertEqual(join_code_from_group("game_ABC_team_role_USAAmbassador"), "ABC")
+        self.assertEqual(join_code_from_group("game_ABC"), "ABC")
+        self.assertIsNone(join_code_from_group("specific.abc!def"))
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        keys = [f"GAME{i}" for i in range(1000)]
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+
+        moved = [key for key in keys if before.node(key) != after.node(key)]
+        self.assertTrue(all(after.node(key) == "d" for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+        self.assertEqual({before.node(key) for key in keys}, {"a", "b", "c"})
+
+# ---------------------------- #
+# Redis script tests           #
+# ---------------------------- #
+class RedisScriptTests(TestCase):
+    def test_scripts_are_registered_once_and_survive_a_flush(self):
+        async def run():
+            redis_client = get_async_game_redis_client("SCRIPT")
+            script = get_script(redis_client, "return ARGV[1]")
+            self.assertIs(get_script(redis_client, "return ARGV[1]"), script)
+            self.assertEqual(await script(args=["a"]), "a")
+
+            # As after Redis restarts, the script has to be loaded again.
+            await redis_client.script_flush()
+            self.assertEqual(await script(args=["b"]), "b")
+
+        async_to_sync(run)()
+
+# ---------------------------- #
+# Coalescing tests             #
+# ---------------------------- #
+class CoalescingTests(TestCase):
+    def test_failed_batch_is_logged_and_the_next_message_starts_a_new_one(self):
+        sent = []
+
+        async def send_to_group(group, channel, action, data):
+            if not sent:
+                sent.append(None)
+                raise ConnectionError("Redis is down")
+
+            sent.append(data)
+
+        async def run():
+            coalesce_message(send_to_group, "game_C", "units", "move", {"id": 1}, 0)
+
+            with self.assertLogs("wargamelogic.coalescing", level="ERROR"):
+                await asyncio.sleep(0.01)
+
+            coalesce_message(send_to_group, "game_C", "units", "move", {"id": 2}, 0)
+            await asyncio.sleep(0.01)
+
+        async_to_sync(run)()
+        self.assertEqual(sent, [None, [{"channel": "units", "action": "move", "data": {"id": 2}}]])
+
+# ---------------------------- #
+# OutboundQueue tests          #
+# ---------------------------- #
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(text_data)
+
+    def test_only_superseded_frames_are_dropped(self):
+        outbound = OutboundQueue(self.send, maxlen=3, policy="drop_superseded")
+
+        self.assertTrue(outbound.put({"text_data": "move 1"}, "units.move.1"))
+        self.assertTrue(outbound.put({"text_data": "chat"}))
+        self.assertTrue(outbound.put({"text_data": "move 2"}, "units.move.2"))
+        self.assertTrue(outbound.put({"text_data": "move 1 again"}, "units.move.1"))
+        self.assertEqual(outbound.dropped, 1)
+        self.assertEqual([frame["text_data"] for frame, _ in outbound._frames], ["chat", "move 2", "move 1 again"])
+
+        # Nothing queued is replaced by a newer frame, so the browser would miss something.
+        self.assertFalse(outbound.put({"text_data": "move 3"}, "units.move.3"))
+        self.assertTrue(outbound.overflowed)
+        self.assertEqual(len(outbound), 0)
+
+    def test_superseded_unit_moves_are_dropped_with_the_default_settings(self):
+        maxlen = settings.WEBSOCKET_OUTBOUND_QUEUE_MAXLEN
+        outbound = OutboundQueue(self.send, maxlen, settings.WEBSOCKET_SLOW_CONSUMER_POLICY)
+
+        for row in range(maxlen + 10):
+            data = {"id": row % 2, "row": row}
+            self.assertTrue(outbound.put({"text_data": encode_message("units", "move", data)}, message_key("units", "move", data)))
+
+        self.assertEqual(outbound.dropped, 10)
+        self.assertEqual([json.loads(frame["text_data"])["data"]["row"] for frame, _ in list(outbound._frames)[-2:]], [maxlen + 8, maxlen + 9])
+
+        # Messages that don't replace each other.
+        self.assertIsNone(message_key("units", "attack", {"attacker_id": 1, "target_id": 2}))
+        self.assertIsNone(message_key("batch", "tick", [{"channel": "units", "action": "move", "data": {"id": 1}}]))
+
+    def test_close_policy_overflows_when_full(self):
+        outbound = OutboundQueue(self.send, maxlen=1, policy="close")
+
+        self.assertTrue(outbound.put({"text_data": "move 1"}, "units.move.1"))
+        self.assertFalse(outbound.put({"text_data": "move 1 again"}, "units.move.1"))
+
+    def test_replies_wait_for_room_instead_of_being_dropped(self):
+        async def run():
+            outbound = OutboundQueue(self.send, maxlen=1, policy="drop_superseded")
+            outbound.put({"text_data": "broadcast"})
+            reply = asyncio.create_task(outbound.put_wait({"text_data": "reply"}))
+
+            await asyncio.sleep(0)
+            self.assertFalse(reply.done())
+
+            task = asyncio.create_task(outbound.run())
+            self.assertTrue(await reply)
+            await asyncio.sleep(0)
+            task.cancel()
+
+        async_to_sync(run)()
+        self.assertEqual(self.sent, ["broadcast", "reply"])
+
+    def test_run_sends_frames_in_order(self):
+        async def run():
+            outbound = OutboundQueue(self.send, maxlen=10, policy="drop_superseded")
+            task = asyncio.create_task(outbound.run())
+
+            for text in ("a", "b", "c"):
+                outbound.put({"text_data": text})
+
+            await asyncio.sleep(0)
+            task.cancel()
+
+        async_to_sync(run)()
+        self.assertEqual(self.sent, ["a", "b", "c"])
+
+# ---------------------------- #
+# MessageRegistry tests        #
+# ---------------------------- #
+class CompileSchemaTests(TestCase):
+    def setUp(self):
+        self.validate = compile_schema({
+            "role.name": str,
+            "last_seq": int,
+            "supply_points": float,
+        })
+
+    def test_matching_data(self):
+        self.assertIsNone(self.validate({"role": {"name": "Ambassador"}, "last_seq": 3, "supply_points": 2}))
+
+    def test_missing_and_wrongly_typed_properties(self):
+        self.assertEqual(self.validate({"role": "Ambassador", "last_seq": 3, "supply_points": 2}), "missing 'role.name'")
+        self.assertEqual(self.validate({"role": {"name": "Ambassador"}, "last_seq": "3", "supply_points": 2}), "'last_seq' must be integer")
+        self.assertEqual(self.validate({"role": {"name": "Ambassador"}, "last_seq": True, "supply_points": 2}), "'last_seq' must be integer")
+        self.assertEqual(self.validate([]), "'data' must be an object")
+
+# ---------------------------- #
+# RateLimiter tests            #
+# ---------------------------- #
+class RateLimiterTests(TestCase):
+    def test_token_bucket_refills_at_its_rate(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        now = bucket.updated_at
+
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        self.assertAlmostEqual(bucket.take(now + 0.25), 0.25)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+
+    def test_action_limits_are_separate_from_the_connection_limit(self):
+        rate_limiter = RateLimiter((1, 3), (1, 2), {"actions.move": (1, 1)})
+
+        self.assertEqual(rate_limiter.check("actions", "move"), 0)
+        self.assertGreater(rate_limiter.check("actions", "move"), 0)
+
+        # The refused move didn't use up one of the connection's messages.
+        self.assertEqual(rate_limiter.check("units", "move"), 0)
+        self.assertEqual(rate_limiter.check("units", "move"), 0)
+        self.assertGreater(rate_limiter.check("turn", "start"), 0)
+
+    def test_only_the_first_refused_message_in_a_row_is_reported(self):
+        rate_limiter = RateLimiter(None, None)
+
+        self.assertFalse(rate_limiter.should_notify(0))
+        self.assertTrue(rate_limiter.should_notify(0.5))
+        self.assertFalse(rate_limiter.should_notify(0.4))
+        self.assertFalse(rate_limiter.should_notify(0))
+        self.assertTrue(rate_limiter.should_notify(0.5))
+
+# ---------------------------- #
+# Logging tests                #
+# ---------------------------- #
+class LoggingTests(TestCase):
+    def make_record(self, msg, *args, **extra):
+        record = logging.LogRecord("wargamelogic.test", logging.WARNING, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_structured_formatter_includes_extra_fields(self):
+        line = StructuredFormatter().format(self.make_record("%s joined", "ws_user", join_code="ABC", user_id=3, path="/"))
+        entry = json.loads(line)
+
+        self.assertEqual((entry["message"], entry["join_code"], entry["user_id"]), ("ws_user joined", "ABC", 3))
+        self.assertNotIn("path", entry)
+
+    def test_records_are_handled_by_a_background_thread(self):
+        handled = []
+
+        class RecordingHandler(logging.Handler):
+            def emit(self, record):
+                handled.append((record.getMessage(), threading.current_thread()))
+
+        queue_handler = BackgroundQueueHandler([RecordingHandler()], maxsize=1)
+        queue_handler.listener.stop()
+
+        # With nothing taking records off the queue, records past the first are dropped rather than waited on.
+        args = ["first"]
+        queue_handler.handle(self.make_record("%s", args))
+        args[0] = "changed"
+        queue_handler.handle(self.make_record("second"))
+        self.assertEqual(queue_handler.dropped, 1)
+
+        queue_handler.listener.start()
+        queue_handler.listener.stop()
+        atexit.unregister(queue_handler.listener.stop)
+        self.assertEqual(handled[0][0], "['first']")
+        self.assertIsNot(handled[0][1], threading.current_thread())
+
+    def test_settings_configure_logging(self):
+        logging.config.dictConfig(copy.deepcopy(settings.LOGGING))
+        handler = logging.getLogger("wargamelogic").handlers[0]
+
+        self.assertIsInstance(handler, BackgroundQueueHandler)
+        self.assertEqual(len(handler.listener.handlers), len(settings.LOGGING["handlers"]["queue"]["handlers"]))
+
+# ---------------------------- #
+# User cache tests             #
+# ---------------------------- #
+@override_settings(AUTH_USER_CACHE_REDIS=False)
+class UserCacheTests(TestCase):
+    def setUp(self):
+        get_user_cache().clear()
+        self.user = User.objects.create_user(username="cached_user", password="pass")
+        self.access_token = str(AccessToken.for_user(self.user))
+
+    def authenticate(self):
+        request = RequestFactory().get("/")
+        request.COOKIES["access_token"] = self.access_token
+        return CookieJWTAuthentication().authenticate(request)[0]
+
+    def test_cached_users_are_authenticated_without_queries(self):
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+
+        self.assertEqual((user.id, user.username, user.is_active), (self.user.id, "cached_user", True))
+
+    def test_changed_users_are_removed_from_the_cache(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(get_cached_user(self.user.id))
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_websocket_connections_are_authenticated_from_the_cache(self):
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = CookieJWTAuthenticationWebSocketMiddleware(app)
+
+        def connect(cookie):
+            async_to_sync(middleware)({"type": "websocket", "headers": [(b"cookie", cookie.encode())]}, None, None)
+            return scopes[-1]["user"]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(connect(f"csrftoken=abc; access_token={self.access_token}").id, self.user.id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(connect(f"access_token={self.access_token}").id, self.user.id)
+
+        self.assertFalse(connect("access_token=invalid").is_authenticated)
+        self.assertFalse(connect("csrftoken=abc").is_authenticated)
+
+# ---------------------------- #
+# Authorization tests          #
+# ---------------------------- #
+class CompiledCriteriaTests(TestCase):
+    def role_instance(self, team_name, role_name):
+        return SimpleNamespace(team_instance=SimpleNamespace(team=SimpleNamespace(name=team_name)), role=SimpleNamespace(name=role_name))
+
+    def test_callables_are_called_once_and_after_fixed_values(self):
+        calls = []
+
+        def team_name(request, kwargs):
+            calls.append(kwargs["team_name"])
+            return kwargs["team_name"]
+
+        criteria = CompiledCriteria({"team_instance.team.name": team_name, "role.name": "Commander"})
+        role_instances = [self.role_instance("USA", "Gamemaster"), self.role_instance("PRC", "Commander"), self.role_instance("USA", "Commander")]
+        expected_values = {}
+
+        self.assertEqual(criteria.matches(None, {"team_name": "USA"}, role_instances[:1], expected_values), (False, {"role.name": "Gamemaster"}))
+        self.assertEqual(calls, [])
+
+        self.assertEqual(criteria.matches(None, {"team_name": "USA"}, role_instances, expected_values), (True, {}))
+        self.assertEqual(calls, ["USA"])
+
+        self.assertEqual(criteria.describe(None, {"team_name": "USA"}, expected_values), {"team_instance.team.name": "USA", "role.name": "Commander"})
+        self.assertEqual(calls, ["USA"])
+
+    def test_errors_are_reported_as_failed_fields(self):
+        def missing(request, kwargs):
+            raise ValueError("missing")
+
+        criteria = CompiledCriteria({"role.name": missing})
+        expected_values = {}
+
+        self.assertEqual(criteria.matches(None, {}, [self.role_instance("USA", "Commander")], expected_values), (False, {"role.name": "<error: missing>"}))
+        self.assertEqual(criteria.describe(None, {}, expected_values), {"role.name": "<error: missing>"})
+
+    def test_game_scoped_criteria_only_load_role_instances_in_that_game(self):
+        user = User.objects.create_user(username="instructor", password="pass")
+        team = Team.objects.create(name="USA")
+        role = Role.objects.create(name="Gamemaster")
+
+        for join_code in ("OLD1", "OLD2", "NEW"):
+            game_instance = GameInstance.objects.create(join_code=join_code)
+            RoleInstance.objects.create(user=user, role=role, team_instance=TeamInstance.objects.create(game_instance=game_instance, team=team))
+
+        request = SimpleNamespace(user=user)
+        criteria = CompiledCriteria({"team_instance.game_instance.join_code": lambda request, kwargs: kwargs["join_code"], "role.name": "Gamemaster"})
+
+        with self.assertNumQueries(1):
+            self.assertEqual(role_instance_matches(request, {"join_code": "NEW"}, criteria), (True, {}))
+
+        role_instances = [value for key, value in request._role_check_cache.items() if key[0] == "role_instances"]
+        self.assertEqual([[ri.team_instance.game_instance.join_code for ri in value] for value in role_instances], [["NEW"]])
+
+    def test_only_the_game_scope_is_looked_up_for_a_role_that_does_not_match(self):
+        user = User.objects.create_user(username="operator", password="pass")
+        team = Team.objects.create(name="USA")
+        game_instance = GameInstance.objects.create(join_code="SCOPE")
+        team_instance = TeamInstance.objects.create(game_instance=game_instance, team=team)
+        RoleInstance.objects.create(user=user, role=Role.objects.create(name="Operations"), team_instance=team_instance)
+        calls = []
+
+        def team_name(request, kwargs):
+            calls.append(kwargs["join_code"])
+            return Team.objects.get(name="USA").name
+
+        criteria = CompiledCriteria({
+            "team_instance.game_instance": lambda request, kwargs: GameInstance.objects.get(join_code=kwargs["join_code"]),
+            "team_instance.team.name": team_name,
+            "role.name": "Gamemaster",
+        })
+
+        # The game's lookup and the user's RoleInstances in it, but not team_name's lookup.
+        with self.assertNumQueries(2):
+            self.assertEqual(role_instance_matches(SimpleNamespace(user=user), {"join_code": "SCOPE"}, criteria), (False, {"role.name": "Operations"}))
+
+        self.assertEqual(calls, [])
+
+# ---------------------------- #
+# Role membership cache tests  #
+# ---------------------------- #
+class RoleMembershipCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="member", password="pass")
+        self.other_user = User.objects.create_user(username="other_member", password="pass")
+        self.team = Team.objects.create(name="USA")
+        self.role = Role.objects.create(name="Gamemaster")
+        self.game_instance = GameInstance.objects.create(join_code="CACHED")
+        self.team_instance = TeamInstance.objects.create(game_instance=self.game_instance, team=self.team)
+        self.role_instance = RoleInstance.objects.create(user=self.user, role=self.role, team_instance=self.team_instance)
+
+    def role_names(self, user):
+        return [role_instance.role.name for role_instance in get_role_memberships(user, team_instance__game_instance_id=self.game_instance.id)]
+
+    def test_role_instances_are_cached_across_requests(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.role_names(self.user), ["Gamemaster"])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.role_names(self.user), ["Gamemaster"])
+
+        # Other processes get them from Redis.
+        _get_local_role_memberships().clear()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.role_names(self.user), ["Gamemaster"])
+
+    def test_changing_role_instances_invalidates_the_cache(self):
+        self.role_names(self.user)
+        self.role_instance.role = Role.objects.create(name="Combatant Commander")
+        self.role_instance.save()
+
+        self.assertEqual(self.role_names(self.user), ["Combatant Commander"])
+
+    def test_changing_a_role_invalidates_every_users_cache(self):
+        request = SimpleNamespace(user=self.user)
+        criteria = CompiledCriteria({"role.is_logistics": True})
+        self.assertEqual(role_instance_matches(request, {}, criteria), (False, {"role.is_logistics": False}))
+
+        self.role.is_logistics = True
+        self.role.save()
+
+        # The next request, which may be on another process.
+        _get_local_role_memberships().clear()
+        request = SimpleNamespace(user=self.user)
+        self.assertEqual(role_instance_matches(request, {}, criteria), (True, {}))
+
+    def test_moving_a_role_instance_to_another_user_invalidates_both(self):
+        gamemaster = User.objects.create_user(username="gm", password="pass", is_staff=True)
+        self.role_names(self.user)
+        self.role_names(self.other_user)
+
+        client = APIClient()
+        client.force_authenticate(user=gamemaster)
+        response = client.patch(f"/api/role-instances/{self.role_instance.id}/", {"user_id": self.other_user.id}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(self.role_names(self.user), [])
+        self.assertEqual(self.role_names(self.other_user), ["Gamemaster"])
+
+# ---------------------------- #
+# GameConsumer tests           #
+# ---------------------------- #
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class GameConsumerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="ws_user", password="testpass")
+        self.join_code = "WS123"
+
+        self.team = Team.objects.create(name="USA")
+        self.role = Role.objects.create(name="Combatant Commander")
+
+        self.game_instance = GameInstance.objects.create(join_code=self.join_code)
+        self.team_instance = TeamInstance.objects.create(game_instance=self.game_instance, team=self.team)
+        self.role_instance = RoleInstance.objects.create(user=self.user, team_instance=self.team_instance, role=self.role)
+
+    def tearDown(self):
+        redis_client = get_game_redis_client(self.join_code)
+        keys = redis_client.keys(f"game_{self.join_code}_*")
+
+        if keys:
+            redis_client.delete(*keys)
+
+    def role_instance_data(self, user):
+        return {
+            "user": {"id": user.id, "username": user.username},
+            "team_instance": {"team": {"name": self.team.name}},
+            "role": {
+                "name": self.role.name,
+                "branch": None,
+                "is_chief_of_staff": False,
+                "is_commander": False,
+                "is_vice_commander": False,
+                "is_logistics": False,
+            },
+        }
+
+    def serialized_role_instance(self):
+        """self.role_instance as the consumer sends it."""
+        return json.loads(json.dumps(RoleInstanceSerializer(self.role_instance).data))
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(GameConsumer.as_asgi(), f"/ws/game-instances/{self.join_code}/")
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"join_code": self.join_code}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_group_message_is_forwarded_verbatim(self):
+        async def run():
+            communicator = await self.connect(self.user)
+            text = encode_message("turn", "start", {"turn": 2})
+            await get_channel_layer().group_send(
+                f"game_{self.join_code}",
+                {"type": "handle.message", "text": text}
+            )
+            self.assertEqual(await communicator.receive_from(), text)
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_frames_built_from_text_match_encoding_with_seq(self):
+        data = {"id": 1, "name": "Tank \"A\"}", "position": [1.5, 2]}
+        text = encode_message("units", "move", data)
+        self.assertEqual(add_seq(text, 7), encode_message("units", "move", data, 7))
+        self.assertEqual(add_seq(text, None), text)
+        self.assertEqual(text_to_message_bytes(add_seq(text, 7)), encode_message_bytes("units", "move", data, 7))
+
+    def test_unhandled_message_is_broadcast_to_game(self):
+        async def run():
+            sender = await self.connect(self.user)
+            other_user = await User.objects.acreate(username="ws_other")
+            receiver = await self.connect(other_user)
+
+            await sender.send_json_to({"channel": "units", "action": "move", "data": {"id": 1}})
+            expected = {"channel": "units", "action": "move", "data": {"id": 1}, "seq": 1}
+            self.assertEqual(await sender.receive_json_from(), expected)
+            self.assertEqual(await receiver.receive_json_from(), expected)
+
+            await sender.disconnect()
+            await receiver.disconnect()
+
+        async_to_sync(run)()
+
+    def test_presence_tracks_join_and_leave(self):
+        async def run():
+            presence = PresenceStore(self.join_code)
+            communicator = await self.connect(self.user)
+            data = self.serialized_role_instance()
+
+            await communicator.send_json_to({"channel": "users", "action": "join", "data": {}})
+            self.assertEqual((await communicator.receive_json_from())["action"], "join")
+            self.assertEqual(await presence.get(self.user.id), data)
+            self.assertEqual(await presence.add(self.user.id, data), (False, []))
+
+            await communicator.send_json_to({"channel": "users", "action": "list", "data": {}})
+            self.assertEqual((await communicator.receive_json_from())["data"], [data])
+
+            await communicator.disconnect()
+            self.assertIsNone(await presence.get(self.user.id))
+
+        async_to_sync(run)()
+
+    def test_stale_presence_is_swept_on_join(self):
+        async def run():
+            presence = PresenceStore(self.join_code)
+            data = self.serialized_role_instance()
+
+            # Left behind by a worker that died without disconnecting the user.
+            await presence.add(self.user.id, data)
+            await get_async_game_redis_client(self.join_code).zadd(f"game_{self.join_code}_presence_seen", {self.user.id: 0})
+            self.assertEqual(await presence.all(), [])
+
+            communicator = await self.connect(self.user)
+            await communicator.send_json_to({"channel": "users", "action": "join", "data": {}})
+
+            leave = await communicator.receive_json_from()
+            self.assertEqual((leave["action"], leave["data"]), ("leave", data))
+            self.assertEqual((await communicator.receive_json_from())["action"], "join")
+            self.assertEqual(await presence.all(), [data])
+
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_presence_is_partitioned_by_team(self):
+        async def run():
+            presence = PresenceStore(self.join_code)
+            usa = self.role_instance_data(self.user)
+            other_user = await User.objects.acreate(username="ws_other")
+            prc = {**self.role_instance_data(other_user), "team_instance": {"team": {"name": "PRC"}}}
+
+            await presence.add(self.user.id, usa)
+            await presence.add(other_user.id, prc)
+
+            self.assertEqual(await presence.team("USA"), [usa])
+            self.assertEqual(await presence.team("PRC"), [prc])
+            self.assertCountEqual(await presence.all(), [usa, prc])
+
+            self.assertEqual(await presence.remove(other_user.id), prc)
+            self.assertEqual(await presence.team("PRC"), [])
+            self.assertEqual(await presence.all(), [usa])
+
+        async_to_sync(run)()
+
+    @override_settings(WEBSOCKET_COALESCED_CHANNELS={"units": 0.05})
+    def test_coalesced_channel_sends_latest_update_per_entity(self):
+        async def run():
+            communicator = await self.connect(self.user)
+
+            for row in range(5):
+                await communicator.send_json_to({"channel": "units", "action": "move", "data": {"id": 1, "row": row}})
+            await communicator.send_json_to({"channel": "units", "action": "move", "data": {"id": 2, "row": 0}})
+
+            self.assertEqual(await communicator.receive_json_from(), {
+                "channel": "batch",
+                "action": "tick",
+                "data": [
+                    {"channel": "units", "action": "move", "data": {"id": 1, "row": 4}},
+                    {"channel": "units", "action": "move", "data": {"id": 2, "row": 0}},
+                ],
+                "seq": 1
+            })
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_msgpack_subprotocol(self):
+        async def run():
+            communicator = WebsocketCommunicator(
+                GameConsumer.as_asgi(), f"/ws/game-instances/{self.join_code}/", subprotocols=["msgpack"]
+            )
+            communicator.scope["user"] = self.user
+            communicator.scope["url_route"] = {"kwargs": {"join_code": self.join_code}}
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, "msgpack")
+
+            message = {"channel": "units", "action": "move", "data": {"id": 1}}
+            await communicator.send_to(bytes_data=msgpack.packb(message))
+            self.assertEqual(msgpack.unpackb(await communicator.receive_from()), {**message, "seq": 1})
+
+            # Messages are sent on to other clients as JSON, which has no binary type.
+            message = {"channel": "units", "action": "move", "data": {"id": 1, "x": b"\x00"}}
+            await communicator.send_to(bytes_data=msgpack.packb(message, use_bin_type=True))
+            error = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(error["data"]["detail"], "could not decode message")
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_messages_are_sent_in_sequence_order(self):
+        async def run():
+            sender = await self.connect(self.user)
+            other_user = await User.objects.acreate(username="ws_other")
+            other_sender = await self.connect(other_user)
+            channel_layer = get_channel_layer()
+            group_send = channel_layer.group_send
+
+            # The first message to be numbered is the slowest to send.
+            async def slow_group_send(group, message):
+                if message.get("text", "").endswith('"seq": 1}'):
+                    await asyncio.sleep(0.1)
+
+                await group_send(group, message)
+
+            channel_layer.group_send = slow_group_send
+
+            try:
+                await sender.send_json_to({"channel": "units", "action": "move", "data": {"id": 1}})
+                await asyncio.sleep(0.01)
+                await other_sender.send_json_to({"channel": "units", "action": "move", "data": {"id": 2}})
+
+                self.assertEqual([(await sender.receive_json_from())["seq"] for _ in range(2)], [1, 2])
+
+            finally:
+                del channel_layer.group_send
+
+            await sender.disconnect()
+            await other_sender.disconnect()
+
+        async_to_sync(run)()
+
+    def test_replay_sends_missed_messages(self):
+        async def run():
+            communicator = await self.connect(self.user)
+
+            await communicator.send_json_to({"channel": "users", "action": "join", "data": {}})
+            self.assertEqual((await communicator.receive_json_from())["seq"], 1)
+
+            for unit_id in (1, 2):
+                await communicator.send_json_to({"channel": "units", "action": "move", "data": {"id": unit_id}})
+                await communicator.receive_json_from()
+
+            await communicator.send_json_to({"channel": "events", "action": "replay", "data": {"last_seq": 1}})
+            self.assertEqual(await communicator.receive_json_from(), {"channel": "units", "action": "move", "data": {"id": 1}, "seq": 2})
+            self.assertEqual(await communicator.receive_json_from(), {"channel": "units", "action": "move", "data": {"id": 2}, "seq": 3})
+
+            await communicator.send_json_to({"channel": "events", "action": "replay", "data": {"last_seq": 7}})
+            self.assertEqual((await communicator.receive_json_from())["action"], "resync")
+
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+        # The log expires once the game has finished.
+        redis_client = get_game_redis_client(self.join_code)
+        for key in (f"game_{self.join_code}_events", f"game_{self.join_code}_event_seq"):
+            self.assertTrue(0 < redis_client.ttl(key) <= settings.WEBSOCKET_EVENT_LOG_TTL)
+
+    def test_move_action_runs_endpoint_and_broadcasts_result(self):
+        team_instance = self.team_instance
+        self.role_instance.role = Role.objects.create(name="Gamemaster")
+        self.role_instance.save()
+
+        unit = Unit.objects.create(
+            name="Infantry", cost=0, domain="Ground", is_logistic=False, type="Light",
+            max_health=20, max_supply_points=4, speed=30, defense_modifier=0, description=""
+        )
+        Tile.objects.create(row=0, column=0)
+        Tile.objects.create(row=1, column=1)
+        unit_instance = UnitInstance.objects.create(
+            team_instance=team_instance, unit=unit, tile=Tile.objects.get(row=0, column=0), health=20, supply_points=4
+        )
+        other_user = User.objects.create_user(username="ws_other", password="testpass")
+
+        async def run():
+            communicator = await self.connect(self.user)
+            move = {"request_id": "1", "unit_instance_id": unit_instance.id, "row": 1, "column": 1}
+
+            await communicator.send_json_to({"channel": "actions", "action": "move", "data": move})
+            result = await communicator.receive_json_from()
+            self.assertEqual((result["action"], result["data"]["request_id"], result["data"]["status"]), ("result", "1", 200))
+
+            broadcast = await communicator.receive_json_from()
+            self.assertEqual((broadcast["channel"], broadcast["action"]), ("units", "move"))
+            self.assertEqual(broadcast["data"]["id"], unit_instance.id)
+
+            # Users without a role that can move the unit are refused, and nothing is broadcast.
+            other = await self.connect(other_user)
+            await other.send_json_to({"channel": "actions", "action": "move", "data": {**move, "request_id": "2"}})
+            self.assertEqual((await other.receive_json_from())["data"]["status"], 403)
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.disconnect()
+            await other.disconnect()
+
+        async_to_sync(run)()
+        unit_instance.refresh_from_db()
+        self.assertEqual((unit_instance.tile.row, unit_instance.tile.column), (1, 1))
+
+    def test_actions_on_another_games_units_are_refused(self):
+        self.role_instance.role = Role.objects.create(name="Gamemaster")
+        self.role_instance.save()
+
+        # The user is also the Gamemaster of another game, whose unit they try to move from this game's socket.
+        other_team_instance = TeamInstance.objects.create(game_instance=GameInstance.objects.create(join_code="OTHER"), team=self.team)
+        RoleInstance.objects.create(user=self.user, team_instance=other_team_instance, role=self.role_instance.role)
+
+        unit = Unit.objects.create(
+            name="Infantry", cost=0, domain="Ground", is_logistic=False, type="Light",
+            max_health=20, max_supply_points=4, speed=30, defense_modifier=0, description=""
+        )
+        tile = Tile.objects.create(row=0, column=0)
+        Tile.objects.create(row=1, column=1)
+        unit_instance = UnitInstance.objects.create(team_instance=self.team_instance, unit=unit, tile=tile, health=20, supply_points=4)
+        other_unit_instance = UnitInstance.objects.create(team_instance=other_team_instance, unit=unit, tile=tile, health=20, supply_points=4)
+
+        async def run():
+            communicator = await self.connect(self.user)
+
+            move = {"request_id": "1", "unit_instance_id": other_unit_instance.id, "row": 1, "column": 1}
+            await communicator.send_json_to({"channel": "actions", "action": "move", "data": move})
+            response = await communicator.receive_json_from()
+            self.assertEqual((response["channel"], response["action"]), ("errors", "invalid"))
+
+            attack = {"request_id": "2", "attacker_id": unit_instance.id, "target_id": other_unit_instance.id, "attack_name": "Standard"}
+            await communicator.send_json_to({"channel": "actions", "action": "attack", "data": attack})
+            self.assertEqual((await communicator.receive_json_from())["action"], "invalid")
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        other_unit_instance.refresh_from_db()
+        self.assertEqual((other_unit_instance.tile.row, other_unit_instance.tile.column), (0, 0))
+
+    def test_invalid_messages_get_an_error_instead_of_closing_the_connection(self):
+        async def run():
+            communicator = await self.connect(self.user)
+
+            await communicator.send_to(text_data="not json")
+            self.assertEqual((await communicator.receive_json_from())["data"]["detail"], "could not decode message")
+
+            for envelope in ({"channel": ["a"], "action": "b"}, {"channel": "units", "action": {"x": 1}}):
+                await communicator.send_json_to(envelope)
+                self.assertEqual((await communicator.receive_json_from())["data"]["detail"], "channel and action must be strings")
+
+            await communicator.send_json_to({"channel": "events", "action": "replay", "data": {"last_seq": "1"}})
+            self.assertEqual(await communicator.receive_json_from(), {
+                "channel": "errors",
+                "action": "invalid",
+                "data": {"channel": "events", "action": "replay", "detail": "'last_seq' must be integer"},
+            })
+
+            await communicator.send_json_to({"channel": "actions", "action": "move", "data": {"request_id": "3"}})
+            self.assertEqual((await communicator.receive_json_from())["data"]["request_id"], "3")
+
+            # Refused by the handler rather than the schema.
+            await communicator.send_json_to({"channel": "users", "action": "ready", "data": {}})
+            self.assertEqual((await communicator.receive_json_from())["action"], "invalid")
+
+            await communicator.send_json_to({"channel": "units", "action": "move", "data": {"id": 1}})
+            self.assertEqual((await communicator.receive_json_from())["channel"], "units")
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(WEBSOCKET_RATE_LIMIT=(1, 3), WEBSOCKET_ACTION_RATE_LIMITS={})
+    def test_messages_sent_too_fast_are_dropped(self):
+        async def run():
+            communicator = await self.connect(self.user)
+
+            for i in range(5):
+                await communicator.send_json_to({"channel": "units", "action": "move", "data": {"id": i, "request_id": str(i)}})
+
+            for i in range(3):
+                self.assertEqual((await communicator.receive_json_from())["data"]["id"], i)
+
+            # Only the first dropped message is reported.
+            throttled = await communicator.receive_json_from()
+            self.assertEqual((throttled["channel"], throttled["action"]), ("errors", "throttled"))
+            self.assertEqual(throttled["data"]["request_id"], "3")
+            self.assertGreater(throttled["data"]["retry_after"], 0)
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_sender_is_the_role_instance_loaded_at_join(self):
+        ambassador = Role.objects.create(name="Ambassador")
+        other_user = User.objects.create_user(username="ws_other", password="testpass")
+        RoleInstance.objects.create(user=other_user, team_instance=self.team_instance, role=ambassador)
+        outsider = User.objects.create_user(username="ws_outsider", password="testpass")
+
+        async def run():
+            sender = await self.connect(self.user)
+            receiver = await self.connect(other_user)
+
+            # Whatever the browser claims to be is ignored.
+            await sender.send_json_to({"channel": "users", "action": "join", "data": {"team_instance": {"team": {"name": "Gamemasters"}}}})
+            self.assertEqual((await sender.receive_json_from())["data"], self.serialized_role_instance())
+            await receiver.send_json_to({"channel": "users", "action": "join", "data": {}})
+            await sender.receive_json_from()
+            await receiver.receive_json_from()
+
+            message = {"recipient_team_name": "USA", "recipient_role_name": "Ambassador", "text": "hi"}
+            await sender.send_json_to({"channel": "communications", "action": "send", "data": message})
+            received = await receiver.receive_json_from()
+            self.assertEqual(received["data"], {**message, "sender_role_instance": self.serialized_role_instance()})
+            self.assertEqual((await sender.receive_json_from())["data"], received["data"])
+
+            await sender.send_json_to({"channel": "points", "action": "spend", "data": {"supply_points": 2, "team_name": "PRC"}})
+            self.assertEqual((await sender.receive_json_from())["data"], {"supply_points": 2, "team_name": "USA", "role_name": "Combatant Commander"})
+
+            # Users without a role in the game can't join it.
+            other = await self.connect(outsider)
+            await other.send_json_to({"channel": "users", "action": "join", "data": {}})
+            self.assertEqual((await other.receive_json_from())["action"], "invalid")
+
+            for communicator in (sender, receiver, other):
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_messages_are_routed_to_team_role_topics(self):
+        ambassador = Role.objects.create(name="Ambassador")
+        other_user = User.objects.create_user(username="ws_other", password="testpass")
+        RoleInstance.objects.create(user=other_user, team_instance=self.team_instance, role=ambassador)
+
+        async def run():
+            sender = await self.connect(self.user)
+            receiver = await self.connect(other_user)
+
+            await sender.send_json_to({"channel": "users", "action": "join", "data": {}})
+            await sender.receive_json_from()
+            await receiver.send_json_to({"channel": "users", "action": "join", "data": {}})
+            await sender.receive_json_from()
+            await receiver.receive_json_from()
+
+            # There are no groups for pairs of roles.
+            groups = get_channel_layer().groups
+            self.assertEqual(
+                sorted(group for group in groups if group.startswith(f"game_{self.join_code}")),
+                [f"game_{self.join_code}", f"game_{self.join_code}_team_USA",
+                 f"game_{self.join_code}_team_role_USAAmbassador", f"game_{self.join_code}_team_role_USACombatantCommander",
+                 f"game_{self.join_code}_user_{self.user.id}", f"game_{self.join_code}_user_{other_user.id}"]
+            )
+
+            message = {"recipient_team_name": "USA", "recipient_role_name": "Ambassador", "text": "hi"}
+            await sender.send_json_to({"channel": "communications", "action": "send", "data": message})
+            self.assertEqual((await receiver.receive_json_from())["data"]["text"], "hi")
+            self.assertEqual((await sender.receive_json_from())["data"]["text"], "hi")
+
+            # Roles the sender can't message are refused.
+            await sender.send_json_to({"channel": "communications", "action": "send", "data": {**message, "recipient_team_name": "PRC"}})
+            self.assertEqual((await sender.receive_json_from())["action"], "invalid")
+            self.assertTrue(await receiver.receive_nothing())
+
+            for communicator in (sender, receiver):
+                await communicator.disconnect()
+
+        async_to_sync(run)()
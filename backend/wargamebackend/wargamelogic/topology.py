@@ -0,0 +1,176 @@
+# This file works out who may talk to whom and who may send supply points to whom.
+# That only depends on the Team and Role tables, so rather than working it out
+# every time a user joins a game, it's worked out once for every (team, role) pair
+# and kept in a RoleTopology, which is rebuilt along with the rest of the
+# StaticCatalog when the static tables change (see static_cache.py).
+# Joining a game then only needs a dictionary lookup.
+
+GAMEMASTER_TEAM_NAME = "Gamemasters"
+GAMEMASTER_ROLE_NAME = "Gamemaster"
+
+def group_name_part(team_name, role_name):
+    """The way a team and role are written in a group name, e.g. "USACombatantCommander"."""
+    return f"{team_name}{role_name}".replace(" ", "")
+
+def team_role_group(join_code, team_name, role_name):
+    """The group of every user in a game with the given team and role."""
+    return f"game_{join_code}_team_role_{group_name_part(team_name, role_name)}"
+
+def channel_pair_name(team_role_1, team_role_2):
+    """
+    The part of a channel group's name after "game_<join_code>_channel_".
+    Both members of a channel share the same group, so the names are sorted.
+    """
+    a, b = sorted([group_name_part(*team_role_1), group_name_part(*team_role_2)])
+    return f"{a}_{b}"
+
+def transfer_pair_name(sender, recipient):
+    """The part of a transfer group's name after "game_<join_code>_transfer_"."""
+    return f"{group_name_part(*sender)}_{group_name_part(*recipient)}"
+
+# -------------------- #
+# topology rules       #
+# -------------------- #
+def get_channel_partners(team_name, role, teams, roles):
+    """
+    Returns the (team name, role name) pairs that a user with the given team and role
+    can send messages to and receive messages from.
+    """
+    role_name = role.name
+    gamemaster = (GAMEMASTER_TEAM_NAME, GAMEMASTER_ROLE_NAME)
+    same_branch_roles = [r for r in roles if r.branch_id is not None and r.branch_id == role.branch_id]
+
+    partners = []
+
+    if role_name == GAMEMASTER_ROLE_NAME:
+        partners += (
+            [gamemaster] +
+            [(t.name, r.name) for r in roles if r.name != GAMEMASTER_ROLE_NAME for t in teams if t.name != GAMEMASTER_TEAM_NAME]
+        )
+
+    if role_name == "Ambassador":
+        partners += (
+            [gamemaster] +
+            [(t.name, role_name) for t in teams if t.name != GAMEMASTER_TEAM_NAME] +
+            [(team_name, "Combatant Commander")] +
+            [(team_name, r.name) for r in roles if r.is_chief_of_staff]
+        )
+
+    if role_name == "Combatant Commander":
+        partners += (
+            [(team_name, role_name), gamemaster, (team_name, "Ambassador")] +
+            [(team_name, r.name) for r in roles if r.is_chief_of_staff]
+        )
+
+    if role.is_chief_of_staff:
+        partners += (
+            [(team_name, role_name), gamemaster, (team_name, "Combatant Commander")] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_commander]
+        )
+
+    if role.is_commander:
+        partners += (
+            [gamemaster] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_chief_of_staff] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_commander] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_vice_commander]
+        )
+
+    if role.is_vice_commander:
+        partners += (
+            [gamemaster] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_commander] +
+            [(team_name, r.name) for r in same_branch_roles if r.is_vice_commander]
+        )
+
+    return partners
+
+def get_transfer_partners(team_name, role, teams, roles):
+    """
+    Returns two lists of (team name, role name) pairs:
+    the ones a user with the given team and role can send supply points to,
+    and the ones they can receive supply points from.
+    """
+    role_name = role.name
+    same_branch_roles = [r for r in roles if r.branch_id is not None and r.branch_id == role.branch_id]
+
+    transfer_to = []
+    transfer_from = []
+
+    if role_name == GAMEMASTER_ROLE_NAME:
+        transfer_to += [(t.name, r.name) for r in roles if r.name != GAMEMASTER_ROLE_NAME for t in teams if t.name != GAMEMASTER_TEAM_NAME]
+    else:
+        transfer_from += [(GAMEMASTER_TEAM_NAME, GAMEMASTER_ROLE_NAME)]
+
+    if role_name == "Combatant Commander":
+        transfer_to += [(team_name, r.name) for r in roles if r.is_chief_of_staff]
+
+    if role.is_chief_of_staff:
+        transfer_to += [(team_name, r.name) for r in same_branch_roles if r.is_logistics and r.is_commander]
+        transfer_from += [(team_name, r.name) for r in roles if r.name == "Combatant Commander"]
+
+    if role.is_commander and role.is_logistics:
+        transfer_to += [(team_name, r.name) for r in same_branch_roles if r.is_logistics and r.is_vice_commander]
+        transfer_from += [(team_name, r.name) for r in same_branch_roles if r.is_chief_of_staff]
+
+    if role.is_vice_commander and role.is_logistics:
+        transfer_from += [(team_name, r.name) for r in same_branch_roles if r.is_commander]
+
+    return transfer_to, transfer_from
+
+# -------------------- #
+# topology index       #
+# -------------------- #
+class RoleTopology:
+    """
+    Who may talk to and transfer supply points to whom, for every (team name, role name) pair.
+    Group names are stored without their "game_<join_code>_..." prefix,
+    so one RoleTopology serves every game.
+    """
+    def __init__(self, teams, roles):
+        self.team_names = tuple(team.name for team in teams)
+        self.role_names = tuple(role.name for role in roles)
+
+        self._channel_partners = {}
+        self._channel_pairs = {}
+        self._transfer_recipients = {}
+        self._transfer_pairs = {}
+
+        for team in teams:
+            for role in roles:
+                key = (team.name, role.name)
+
+                channel_partners = get_channel_partners(team.name, role, teams, roles)
+                self._channel_partners[key] = frozenset(channel_partners)
+                self._channel_pairs[key] = tuple(sorted({
+                    channel_pair_name(key, partner) for partner in channel_partners
+                }))
+
+                transfer_to, transfer_from = get_transfer_partners(team.name, role, teams, roles)
+                self._transfer_recipients[key] = frozenset(transfer_to)
+                self._transfer_pairs[key] = (
+                    tuple(sorted({transfer_pair_name(key, recipient) for recipient in transfer_to})) +
+                    tuple(sorted({transfer_pair_name(sender, key) for sender in transfer_from}))
+                )
+
+    def channel_groups(self, join_code, team_name, role_name):
+        """The channel groups a user with the given team and role belongs to in a game."""
+        return [
+            f"game_{join_code}_channel_{pair}"
+            for pair in self._channel_pairs.get((team_name, role_name), ())
+        ]
+
+    def transfer_groups(self, join_code, team_name, role_name):
+        """The transfer groups a user with the given team and role belongs to in a game."""
+        return [
+            f"game_{join_code}_transfer_{pair}"
+            for pair in self._transfer_pairs.get((team_name, role_name), ())
+        ]
+
+    def can_communicate(self, sender, recipient):
+        """sender and recipient are (team name, role name) pairs."""
+        return recipient in self._channel_partners.get(sender, ())
+
+    def can_transfer(self, sender, recipient):
+        """sender and recipient are (team name, role name) pairs."""
+        return recipient in self._transfer_recipients.get(sender, ())
@@ -16,6 +16,7 @@ from wargamelogic.serializers import (
 from auth.authorization import (
     require_role_instance, require_any_role_instance, get_object_and_related_with_cache_or_404
 )
+from auth.role_cache import invalidate_role_memberships
 
 
 # static model view sets
@@ -193,6 +194,15 @@ class RoleInstanceViewSet(viewsets.ModelViewSet):
     serializer_class = RoleInstanceSerializer
     http_method_names = ['get', 'patch', 'put', 'delete']
 
+    def perform_update(self, serializer):
+        # Saving sends post_save for the RoleInstance's new user,
+        # but if it was moved to another user, the old one's roles have changed too.
+        previous_user_id = serializer.instance.user_id
+        super().perform_update(serializer)
+
+        if serializer.instance.user_id != previous_user_id:
+            invalidate_role_memberships(previous_user_id)
+
     @require_role_instance({
         'team_instance.game_instance': lambda request, kwargs: get_object_or_404(RoleInstance, pk=kwargs['pk']).team_instance.game_instance,
         'role.name':'Gamemaster'
@@ -4,7 +4,7 @@ from rest_framework.decorators import api_view, authentication_classes, permissi
 from auth.authentication import CookieJWTAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from wargamelogic.consumers import get_redis_client
+from wargamelogic.redis_clients import get_game_redis_client
 from wargamelogic.models.dynamic import (
     GameInstance
 )
@@ -24,7 +24,7 @@ def delete_game_instance(request, join_code):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
     game_instance.delete()
 
-    redis_client = get_redis_client()
+    redis_client = get_game_redis_client(join_code)
     keys = redis_client.keys(f"game_{join_code}_*")
 
     if keys:
@@ -5,7 +5,7 @@ from rest_framework.decorators import api_view, authentication_classes, permissi
 from auth.authentication import CookieJWTAuthentication
 from rest_framework.permissions import IsAuthenticated
 from wargamelogic.models.static import (
-    Team, Role, Unit, Attack, Ability, Landmark, Tile
+    Tile
 )
 from wargamelogic.models.dynamic import (
     GameInstance, TeamInstance, RoleInstance, TeamInstanceRolePoints, UnitInstance, LandmarkInstance, LandmarkInstanceTile
@@ -14,6 +14,9 @@ from wargamelogic.serializers import (
     TeamSerializer, RoleSerializer, UnitSerializer, AttackSerializer, AbilitySerializer, LandmarkSerializer, TileSerializer,
     GameInstanceSerializer, TeamInstanceSerializer, RoleInstanceSerializer, TeamInstanceRolePointsSerializer, UnitInstanceSerializer, LandmarkInstanceSerializer,
 )
+from wargamelogic.static_cache import (
+    get_static_catalog, get_cached_or_404
+)
 from auth.authorization import (
     require_role_instance, require_any_role_instance
 )
@@ -50,7 +53,7 @@ def validate_map_access(request, join_code):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_team_by_name(request, name):
-    team = get_object_or_404(Team, name=name)
+    team = get_cached_or_404(get_static_catalog().teams_by_name, name)
     serializer = TeamSerializer(team)
     return Response(serializer.data)
 
@@ -58,7 +61,7 @@ def get_team_by_name(request, name):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_role_by_name(request, name):
-    role = get_object_or_404(Role, name=name)
+    role = get_cached_or_404(get_static_catalog().roles_by_name, name)
     serializer = RoleSerializer(role)
     return Response(serializer.data)
 
@@ -66,7 +69,7 @@ def get_role_by_name(request, name):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_unit_by_name(request, unit_name):
-    unit = get_object_or_404(Unit, name=unit_name)
+    unit = get_cached_or_404(get_static_catalog().units_by_name, unit_name)
     serializer = UnitSerializer(unit)
     return Response(serializer.data)
 
@@ -74,8 +77,7 @@ def get_unit_by_name(request, unit_name):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_attack_by_unit_and_name(request, unit_name, attack_name):
-    unit = get_object_or_404(Unit, name=unit_name)
-    attack = get_object_or_404(Attack, unit=unit, name=attack_name)
+    attack = get_cached_or_404(get_static_catalog().attacks_by_unit_and_name, (unit_name, attack_name))
     serializer = AttackSerializer(attack)
     return Response(serializer.data)
 
@@ -83,8 +85,7 @@ def get_attack_by_unit_and_name(request, unit_name, attack_name):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_ability_by_unit_and_name(request, unit_name, ability_name):
-    unit = get_object_or_404(Unit, name=unit_name)
-    ability = get_object_or_404(Ability, unit=unit, name=ability_name)
+    ability = get_cached_or_404(get_static_catalog().abilities_by_unit_and_name, (unit_name, ability_name))
     serializer = AbilitySerializer(ability)
     return Response(serializer.data)
 
@@ -92,7 +93,7 @@ def get_ability_by_unit_and_name(request, unit_name, ability_name):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_landmark_by_name(request, name):
-    landmark = get_object_or_404(Landmark, name=name)
+    landmark = get_cached_or_404(get_static_catalog().landmarks_by_name, name)
     serializer = LandmarkSerializer(landmark)
     return Response(serializer.data)
 
@@ -118,7 +119,7 @@ def get_game_by_join_code(request, join_code):
 @permission_classes([IsAuthenticated])
 def get_game_team_instance_by_name(request, join_code, team_name):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    team = get_cached_or_404(get_static_catalog().teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
     serializer = TeamInstanceSerializer(team_instance)
     return Response(serializer.data)
@@ -137,7 +138,7 @@ def get_game_role_instances(request, join_code):
 @permission_classes([IsAuthenticated])
 def get_game_role_instances_by_team(request, join_code, team_name):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    team = get_cached_or_404(get_static_catalog().teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
     role_instances = get_list_or_404(RoleInstance, team_instance=team_instance)
     serializer = RoleInstanceSerializer(role_instances, many=True)
@@ -148,9 +149,10 @@ def get_game_role_instances_by_team(request, join_code, team_name):
 @permission_classes([IsAuthenticated])
 def get_game_role_instances_by_team_and_role(request, join_code, team_name, role_name):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    static_catalog = get_static_catalog()
+    team = get_cached_or_404(static_catalog.teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
-    role = get_object_or_404(Role, name=role_name)
+    role = get_cached_or_404(static_catalog.roles_by_name, role_name)
     role_instances = get_list_or_404(RoleInstance, team_instance=team_instance, role=role)
     serializer = RoleInstanceSerializer(role_instances, many=True)
     return Response(serializer.data)
@@ -160,9 +162,10 @@ def get_game_role_instances_by_team_and_role(request, join_code, team_name, role
 @permission_classes([IsAuthenticated])
 def get_game_team_instance_role_points(request, join_code, team_name, role_name):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    static_catalog = get_static_catalog()
+    team = get_cached_or_404(static_catalog.teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
-    role = get_object_or_404(Role, name=role_name)
+    role = get_cached_or_404(static_catalog.roles_by_name, role_name)
     team_instance_role_points = get_object_or_404(TeamInstanceRolePoints, team_instance=team_instance, role=role)
     serializer = TeamInstanceRolePointsSerializer(team_instance_role_points)
     return Response(serializer.data)
@@ -196,7 +199,7 @@ def get_game_unit_instances(request, join_code):
 ])
 def get_game_unit_instances_by_team_name(request, join_code, team_name):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    team = get_cached_or_404(get_static_catalog().teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
     unit_instances = UnitInstance.objects.filter(team_instance=team_instance)
     serializer = UnitInstanceSerializer(unit_instances, many=True)
@@ -220,7 +223,7 @@ def get_game_unit_instances_by_team_name(request, join_code, team_name):
 ])
 def get_game_unit_instances_by_team_name_and_branch(request, join_code, team_name, branch):
     game_instance = get_object_or_404(GameInstance, join_code=join_code)
-    team = get_object_or_404(Team, name=team_name)
+    team = get_cached_or_404(get_static_catalog().teams_by_name, team_name)
     team_instance = get_object_or_404(TeamInstance, game_instance=game_instance, team=team)
     unit_instances = UnitInstance.objects.filter(
         team_instance=team_instance,
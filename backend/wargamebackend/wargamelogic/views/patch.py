@@ -279,7 +279,10 @@ def use_attack(request, pk, attack_name):
         request, UnitInstance, pk=attacker_id, select_related=["unit", "team_instance"]
     )
 
-    role_instances = get_user_role_instances(request)
+    # Scoped like the authorization check's own lookup, so it's reused rather than made again.
+    role_instances = get_user_role_instances(
+        request, team_instance__game_instance_id=attacker_instance.team_instance.game_instance_id
+    )
     role_instance = next(
         (ri for ri in role_instances if ri.team_instance_id == attacker_instance.team_instance_id),
         None
@@ -314,6 +317,7 @@ def use_attack(request, pk, attack_name):
             "target_id": target_instance.id,
             "attack_used": attack.name,
             "supply_points_remaining": attacker_instance.supply_points,
+            "target_health": target_instance.health,
             "message": f"{attacker_instance.unit.name} used {attack.name}. {message}"
         },
         status=status.HTTP_200_OK
@@ -65,8 +65,6 @@ export default function AddUnitInstance({ joinCode, socketRef, socketReady, role
                         channel: "points",
                         action: "spend",
                         data: {
-                            team_name: roleInstance.team_instance.team.name,
-                            role_name: roleInstance.role.name,
                             supply_points: unitCost
                         }
                     }));
@@ -83,7 +81,6 @@ export default function AddUnitInstance({ joinCode, socketRef, socketReady, role
                     action: "send",
                     data: {
                         id: crypto.randomUUID(),
-                        sender_role_instance: roleInstance,
                         recipient_team_name: roleInstance.team_instance.team.name,
                         recipient_role_name: roleInstance.role.name,
                         type: "system",
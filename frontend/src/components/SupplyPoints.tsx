@@ -224,7 +224,6 @@ export default function SupplyPoints({ joinCode, socketRef, socketReady, viewerR
                         action: "send",
                         data: {
                             id: crypto.randomUUID(),
-                            sender_role_instance: viewerRoleInstance,
                             recipient_team_name: messageRecipientTeamName,
                             recipient_role_name: messageRecipientRoleName,
                             text: String(transfer.supply_points),
@@ -243,7 +242,6 @@ export default function SupplyPoints({ joinCode, socketRef, socketReady, viewerR
                         action: "send",
                         data: {
                             id: crypto.randomUUID(),
-                            sender_role_instance: viewerRoleInstance,
                             recipient_team_name: transfer.team_instance.team.name,
                             recipient_role_name: transfer.role.name,
                             type: "system",
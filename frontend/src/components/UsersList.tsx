@@ -41,7 +41,7 @@ export default function UsersList({ socketRef, socketReady, roleInstance, roleIn
                             socket.send(JSON.stringify({
                                 channel: "users",
                                 action: "join",
-                                data: roleInstance
+                                data: {}
                             }));
                         }
 
@@ -72,7 +72,7 @@ export default function UsersList({ socketRef, socketReady, roleInstance, roleIn
             socket.send(JSON.stringify({
                 channel: "users",
                 action: "list",
-                data: roleInstance
+                data: {}
             }));
         }
 
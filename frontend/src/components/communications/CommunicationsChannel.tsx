@@ -114,7 +114,6 @@ export default function CommunicationsChannel({ socketRef, socketReady, viewerRo
                     action: "send",
                     data: {
                         id: crypto.randomUUID(),
-                        sender_role_instance: viewerRoleInstance,
                         recipient_team_name: recipientTeamName,
                         recipient_role_name: recipientRoleName,
                         text: input,